@@ -22,32 +22,57 @@
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
-import os, tarfile, glob, re
+import os, io, tarfile, glob, re, tempfile, hashlib, cProfile, threading, multiprocessing
 import subprocess as sp
-import joblib
 import numpy as np
 import pandas as pd
-import itertools
+import scipy.sparse
 
+from array import array
 from pathlib import Path
-from collections import defaultdict
+from argparse import Namespace
+from collections import defaultdict, Counter
+from contextlib import redirect_stdout, contextmanager
+from concurrent.futures import ProcessPoolExecutor
 
 # Project imports
 from prodigal import prodigal
-from hmmsearch import hmmsearch
+from hmmsearch import hmmsearch, build_hmm_database, hmm_set_fingerprint, HMMSEARCH_ARCHIVE
 from cas import CAS_SYNONYM_LIST, CORE, CAS_PATTERN
+from model_registry import ModelRegistry
+from server import serve
+from hitcache import HitCache
+from metrics import metrics
+from prediction_writer import PredictionWriter, merge_prediction_files
+from run_manifest import RunManifest, shard_spec, shard_samples
+from pipeline import run_pipeline
+from stage_stamps import StageStamps, fingerprint, file_digest, frame_digest, STAMPS_DIR
+from fasta import fasta_index, open_fasta, strip_compressed_extension, COMPRESSED_EXTENSIONS
 
 REGRESSORS = {'CART' : 'DecisionTreeRegressor', 'ERT' : 'ExtraTreesRegressor', 'SVM' : 'SVR'}
 CLASSIFIERS = {'CART' : 'DecisionTreeClassifier', 'ERT' : 'ExtraTreesClassifier', 'SVM' : 'SVC'}
 CLASSIFIERS_INV = {v : k for k, v in CLASSIFIERS.items()}
 BASE_DIR = os.path.dirname(os.path.realpath(__file__))
 HMM_DIR = BASE_DIR + '/HMM_sets'
+HMM_DB_DIR = BASE_DIR + '/HMM_databases'
 MODELS_DIR = BASE_DIR + '/trained_models'
+FLAT_MODELS_DIR = BASE_DIR + '/trained_models_flat'
 MODELS_TAR_GZ = BASE_DIR + '/trained_models.tar.gz'
 HMM_TAR_GZ = BASE_DIR + '/HMM_sets.tar.gz'
 HMMSEARCH = 'hmmsearch'
 PRODIGAL = 'prodigal'
 MAX_N_MISS = 2
+# most unknown proteins between two annotated proteins of a cassette
+MAX_GAP = 2
+# fewest proteins (of all contigs) segmented in worker processes with -t; sending the contig arrays to the workers
+# costs about as much per protein as segmenting them, so smaller tables are faster in one process
+PARALLEL_SEGMENT_PROTEINS = 1000000
+# number of target sequences the E-values of the hit cache searches are computed for (hmmsearch -Z), as the
+# sequences searched in a run depend on what is already cached
+HIT_CACHE_TARGETS = 5000
+FASTA_EXTENSIONS = ('.fasta', '.fa', '.fna', '.faa', '.fas')
+# gzip or bgzip compressed fasta files are read as they are (see fasta.py)
+INPUT_EXTENSIONS = FASTA_EXTENSIONS + tuple(ext + c_ext for ext in FASTA_EXTENSIONS for c_ext in COMPRESSED_EXTENSIONS)
 
 def cmd_exists(cmd):
     if sp.call(cmd, shell=True, stdout=sp.PIPE, stderr=sp.PIPE) != 0:
@@ -58,6 +83,14 @@ def to_list(s):
         return [s]
     return s
 
+def process_pool_context():
+    # worker processes started from a pipeline thread (see pipeline.py) are not forked, as the other threads may hold
+    # locks (e.g. of the metrics) that the workers would inherit locked
+    if threading.current_thread() is not threading.main_thread():
+        return multiprocessing.get_context('forkserver')
+
+    return None
+
 def extract_targz(targz_file_path):
     if not os.path.exists(targz_file_path):
         raise ValueError(f'{targz_file_path} file not found. You should download it from our Google Drive. See README.md for details.')
@@ -74,36 +107,77 @@ def parse_protein_id_from_dna(line):
     strand = int(strand)
     id_second_part = id_second_part.strip().split(';')[0]
     id_ = id_first_part + '_' + id_second_part
-    return id_, start, end, strand
+    contig = id_first_part.rsplit('_', 1)[0] # prodigal names proteins <contig>_<gene number>
+    return id_, start, end, strand, contig
 
-def build_initial_dataframe(fasta_file, sequence_type):
-    data = defaultdict(list)
-    protein_ids = []
+def header_protein_id(line, sequence_type):
+    # protein id of a fasta header line, as in build_initial_dataframe
+    if sequence_type == 'protein':
+        return line.strip().replace('>', '').split()[0]
+
+    return parse_protein_id_from_dna(line)[0]
 
-    with open(fasta_file, 'r') as f:
+def read_protein_sequences(fasta_file, sequence_type):
+    # yields the protein id (as in build_initial_dataframe), the header line and the sequence of each fasta record
+    id_, header, sequence = None, None, []
+
+    with open_fasta(fasta_file) as f:
         for line in f:
             if line.startswith('>'):
-                if sequence_type == 'protein':
-                    id_ = line.strip().replace('>', '').split()[0]
-                else:
-                    id_, start, end, strand = parse_protein_id_from_dna(line)
-                                
-                if id_ not in protein_ids:
-                    protein_ids.append(id_)
+                if header is not None:
+                    yield id_, header, ''.join(sequence)
 
-                    if sequence_type == 'dna':
-                        data['start'].append(start)
-                        data['end'].append(end)
-                        data['strand'].append(strand)
+                header, sequence = line, []
+                id_ = header_protein_id(line, sequence_type)
+            else:
+                sequence.append(line.strip())
+
+    if header is not None:
+        yield id_, header, ''.join(sequence)
+
+def build_initial_dataframe(fasta_file, sequence_type):
+    # protein ids are kept in a dict (insertion ordered) for constant time duplicate checks
+    protein_ids = {}
+    contigs = []
+    starts = array('q')
+    ends = array('q')
+    strands = array('b')
+
+    # only the header lines are read (see scan_headers in fasta.py), and the index is kept for the two-stage search
+    for line in fasta_index(fasta_file).headers:
+        if sequence_type == 'protein':
+            id_ = line.strip().replace('>', '').split()[0]
+        else:
+            id_, start, end, strand, contig = parse_protein_id_from_dna(line)
+                        
+        if id_ not in protein_ids:
+            protein_ids[id_] = None
+
+            if sequence_type == 'dna':
+                contigs.append(contig)
+                starts.append(start)
+                ends.append(end)
+                strands.append(strand)
+
+    data = {}
 
-    return pd.DataFrame(data, index=protein_ids)
+    if sequence_type == 'dna':
+        data['contig'] = contigs
+        data['start'] = np.asarray(starts)
+        data['end'] = np.asarray(ends)
+        data['strand'] = np.asarray(strands)
 
-def annotate_proteins(initial_protein_df, hmmsearch_output_dir, hmm_sets, sequence_type, cassette_output_dir=None, save_csv=False):
+    return pd.DataFrame(data, index=list(protein_ids))
+
+def annotate_proteins(initial_protein_df, hmmsearch_output_dir, hmm_sets, sequence_type, cassette_output_dir=None, save_csv=False, hmm_hits=None):
     annotated_protein_dataframes = {}
 
     for hmm in hmm_sets:
-        protein_df = initial_protein_df.copy()
-        annotated_protein_dataframes[hmm] = add_bitscores(os.path.join(hmmsearch_output_dir, hmm), protein_df, sequence_type)
+        # add_bitscores returns a new dataframe, initial_protein_df itself is never modified
+        if hmm_hits is None:
+            annotated_protein_dataframes[hmm] = add_bitscores(os.path.join(hmmsearch_output_dir, hmm), initial_protein_df, sequence_type)
+        else:
+            annotated_protein_dataframes[hmm] = assign_best_hits(initial_protein_df, hmm_hits[hmm])
 
         if save_csv:
             annotated_protein_dataframes[hmm].to_csv(os.path.join(cassette_output_dir, hmm + '_annotated_proteins.csv'))
@@ -111,276 +185,1043 @@ def annotate_proteins(initial_protein_df, hmmsearch_output_dir, hmm_sets, sequen
     return annotated_protein_dataframes
 
 def add_bitscores(hmm_output_dir, protein_df, sequence_type):
-    protein_df = protein_df.assign(bitscore=np.repeat(-1.0, protein_df.shape[0]))
-    protein_df = protein_df.assign(annotation=np.repeat('unknown', protein_df.shape[0]))
+    hits = read_hmmsearch_hits(hmm_output_dir, sequence_type)
+    return assign_best_hits(protein_df, hits)
+
+def profile_annotation(hmm_file_name):
+    annotation = hmm_file_name.split('_')[0].split('-')[0].lower()
+    annotation = re.match(CAS_PATTERN, annotation)
+
+    if annotation:
+        annotation = annotation.group()
+        return CAS_SYNONYM_LIST.get(annotation, annotation)
+
+    return None
+
+def read_hmmsearch_hits(hmm_output_dir, sequence_type):
+    tab_files = {}
+
+    for file_path in glob.glob(hmm_output_dir + '/*.tab'):
+        with open(file_path, 'r') as f:
+            tab_files[os.path.basename(file_path)] = f.readlines()
+
+    return parse_hmmsearch_hits(tab_files, sequence_type)
 
-    hmm_output_files = glob.glob(hmm_output_dir + '/*.tab')
+def parse_hmmsearch_hits(tab_files, sequence_type):
+    # all hits of an HMM set ({tab file name: tblout lines}) as a (protein, annotation, bitscore) table, in file and line order
+    protein_ids = []
+    annotations = []
+    bitscores = []
 
-    for file_path in hmm_output_files:
-        _, tab_file = file_path.rsplit('/', 1)
-        annotation = tab_file.split('_')[0].split('-')[0].lower()
-        annotation = re.match(CAS_PATTERN, annotation)
+    for tab_file, lines in tab_files.items():
+        annotation = profile_annotation(tab_file)
 
         if annotation:
-            annotation = annotation.group()
-        
-            if annotation in CAS_SYNONYM_LIST:
-                annotation = CAS_SYNONYM_LIST[annotation]
+            n_hits = len(protein_ids)
 
-            with open(file_path, 'r') as f:
-                for line in f:
-                    if not line.startswith('#'):
-                        hmm_result = line.strip().split()
+            for line in lines:
+                if not line.startswith('#'):
+                    hmm_result = line.split()
+                    id_ = hmm_result[0]
 
-                        id_ = hmm_result[0]
-                        bitscore = float(hmm_result[5])
+                    if sequence_type == 'dna':
+                        id_ += '_' + hmm_result[-1].split(';')[0]
 
-                        if sequence_type == 'dna':
-                            id_second_part = hmm_result[-1].strip().split(';')[0]
-                            id_ += '_' + id_second_part
-                        
-                        if bitscore > protein_df.at[id_, 'bitscore'] and bitscore > 0.0:
-                            protein_df.at[id_, 'bitscore'] = bitscore
-                            protein_df.at[id_, 'annotation'] = annotation
+                    protein_ids.append(id_)
+                    bitscores.append(hmm_result[5])
+
+            annotations.extend([annotation] * (len(protein_ids) - n_hits))
+
+    return pd.DataFrame({'protein' : protein_ids, 'annotation' : annotations, 'bitscore' : np.array(bitscores, dtype=float)})
+
+def assign_best_hits(protein_df, hits):
+    protein_df = protein_df.assign(bitscore=np.repeat(-1.0, protein_df.shape[0]), annotation=np.repeat('unknown', protein_df.shape[0]))
+
+    unknown_proteins = ~hits['protein'].isin(protein_df.index)
+
+    if unknown_proteins.any():
+        raise KeyError(hits['protein'][unknown_proteins].iloc[0])
+
+    # best positive hit of each protein; on equal bitscores the first hit read wins
+    hits = hits[hits['bitscore'] > 0.0]
+    best_hits = hits.sort_values('bitscore', ascending=False, kind='mergesort').drop_duplicates('protein')
+
+    protein_df.loc[best_hits['protein'].values, 'bitscore'] = best_hits['bitscore'].values
+    protein_df.loc[best_hits['protein'].values, 'annotation'] = best_hits['annotation'].values
         
     return protein_df
 
-def build_cassettes(annotated_protein_dataframes, sequence_type, max_gap=2, min_proteins=2, max_nt_diff=500, cassette_output_dir=None, save_csv=False):
+def build_cassettes(annotated_protein_dataframes, sequence_type, max_gap=MAX_GAP, min_proteins=2, max_nt_diff=500, cassette_output_dir=None, save_csv=False, n_jobs=1):
     cassette_dataframes = {}
 
     for hmm, protein_df in annotated_protein_dataframes.items():
 
         if sequence_type == 'protein':
-            cassette_ids = np.ones(protein_df.shape[0], dtype=np.int)
+            cassette_ids = np.ones(protein_df.shape[0], dtype=int)
             cassette_df = protein_df
         
         else:
-            cassettes = []
-            indices_cassette = []
-            gap = 0
-            cas_count = 0
-            
-            for i, (idx, row) in enumerate(protein_df.iterrows()):
-                nt_diff = row['start'] - protein_df.iloc[i - 1]['end'] if i > 0 else 0
-
-                if ((row['annotation'] != 'unknown' and len(indices_cassette) == 0) or \
-                    (row['annotation'] != 'unknown' and nt_diff <= max_nt_diff)) and \
-                    gap <= max_gap:
-                    indices_cassette.append(idx)
-                    gap = 0
-                    cas_count += 1
-
-                elif i > 0 and len(indices_cassette) > 0 and row['annotation'] == 'unknown' and nt_diff <= max_nt_diff and gap < max_gap:
-                    indices_cassette.append(idx)
-                    gap += 1
-
-                elif len(indices_cassette) > 0 and cas_count >= min_proteins:
-                    for idx2filter in list(reversed(indices_cassette)):
-                        if protein_df.at[idx2filter, 'annotation'] == 'unknown':
-                            indices_cassette.pop()
-                        else:
-                            break
-
-                    protein_df_cassette = protein_df.loc[indices_cassette]
-                    unique_cassette_proteins = set(protein_df_cassette[protein_df_cassette['annotation'] != 'unknown']['annotation'])
-
-                    if len(unique_cassette_proteins) > 1 and len(unique_cassette_proteins.intersection(CORE)) >= 1:
-                        cassettes.append(indices_cassette)
-
-                    gap = 0
-                    cas_count = 0
-                    indices_cassette = []
-
-                else:
-                    gap = 0
-                    cas_count = 0
-                    indices_cassette = []
-
-            cassette_ids = [[i + 1] * len(c) for i, c in enumerate(cassettes)]
-            cassette_ids = list(itertools.chain.from_iterable(cassette_ids))
-            cassettes = list(itertools.chain.from_iterable(cassettes))
-            cassette_df = protein_df.loc[cassettes]
+            starts = protein_df['start'].values
+            ends = protein_df['end'].values
+            annotations = protein_df['annotation'].values
+
+            # proteins are grouped by contig in prodigal's output, so each run of equal contig names is segmented on its own
+            if 'contig' in protein_df and protein_df.shape[0] > 0:
+                contigs = protein_df['contig'].values
+                bounds = np.concatenate(([0], np.flatnonzero(contigs[1:] != contigs[:-1]) + 1, [protein_df.shape[0]]))
+            else:
+                bounds = np.array([0, protein_df.shape[0]])
+
+            segments = [(starts[b:e], ends[b:e], annotations[b:e], max_gap, min_proteins, max_nt_diff) for b, e in zip(bounds[:-1], bounds[1:])]
+
+            workers = min(n_jobs, len(segments))
+
+            if workers > 1 and protein_df.shape[0] >= PARALLEL_SEGMENT_PROTEINS:
+                with ProcessPoolExecutor(max_workers=workers, mp_context=process_pool_context()) as executor:
+                    contig_cassettes = list(executor.map(segment_cassettes, *zip(*segments), chunksize=max(1, len(segments) // (4 * workers))))
+            else:
+                contig_cassettes = [segment_cassettes(*segment) for segment in segments]
+
+            cassettes = [b + np.asarray(c) for b, found in zip(bounds, contig_cassettes) for c in found]
+            cassette_ids = np.repeat(np.arange(1, len(cassettes) + 1), [len(c) for c in cassettes])
+            positions = np.concatenate(cassettes) if cassettes else np.empty(0, dtype=int)
+            cassette_df = protein_df.iloc[positions]
         
         cassette_df = cassette_df.assign(cassette_id=cassette_ids)
 
         if save_csv:
             cassette_df.to_csv(os.path.join(cassette_output_dir, hmm + '_cassettes.csv'))
         
-        cassette_dataframes[hmm] = cassette_df.assign(cassette_id=cassette_ids)
+        cassette_dataframes[hmm] = cassette_df
 
     return cassette_dataframes
 
-def convert_cassette_dataframes_to_numpy_arrays(cassette_dataframes, models_dir, cassette_output_dir):
+def segment_cassettes(starts, ends, annotations, max_gap=MAX_GAP, min_proteins=2, max_nt_diff=500):
+    # Positions of the proteins of each cassette found in one contig. Cas proteins are chained while the
+    # distance to the previous protein is at most max_nt_diff, with at most max_gap unknown proteins in between.
+    starts = starts.tolist()
+    ends = ends.tolist()
+    annotations = annotations.tolist()
+    cassettes = []
+    indices_cassette = []
+    gap = 0
+    cas_count = 0
+
+    def close_cassette():
+        while annotations[indices_cassette[-1]] == 'unknown':
+            indices_cassette.pop()
+
+        unique_cassette_proteins = set(annotations[i] for i in indices_cassette if annotations[i] != 'unknown')
+
+        if len(unique_cassette_proteins) > 1 and len(unique_cassette_proteins.intersection(CORE)) >= 1:
+            cassettes.append(indices_cassette)
+
+    for i in range(len(starts)):
+        nt_diff = starts[i] - ends[i - 1] if i > 0 else 0
+        known = annotations[i] != 'unknown'
+
+        if known and (len(indices_cassette) == 0 or nt_diff <= max_nt_diff) and gap <= max_gap:
+            indices_cassette.append(i)
+            gap = 0
+            cas_count += 1
+
+        elif i > 0 and len(indices_cassette) > 0 and not known and nt_diff <= max_nt_diff and gap < max_gap:
+            indices_cassette.append(i)
+            gap += 1
+
+        else:
+            if len(indices_cassette) > 0 and cas_count >= min_proteins:
+                close_cassette()
+
+            gap = 0
+            cas_count = 0
+            indices_cassette = []
+
+    # the end of a contig also closes the cassette being built
+    if len(indices_cassette) > 0 and cas_count >= min_proteins:
+        close_cassette()
+
+    return cassettes
+
+def convert_cassette_dataframes_to_numpy_arrays(cassette_dataframes, registry, cassette_output_dir, array_format=None):
     hmm_cassette_arrays = {}
     hmm_features = {}
     hmm_missings = {}
 
     for hmm, cassette_df in cassette_dataframes.items():
-        features = joblib.load(os.path.join(models_dir, hmm + '_features.joblib'))
-        feature_to_idx = dict(zip(features, np.arange(len(features))))
-        n_missings = []
-        cassette_arrays = []
-
-        for idx, cassette in cassette_df.groupby(by='cassette_id'):
-            array = np.zeros(len(features))
-            n_miss = (cassette['annotation'] == 'unknown').sum()
-
-            for _, row in cassette.iterrows():
-                if row['annotation'] != 'unknown' and row['annotation'] in feature_to_idx:
-                    j = feature_to_idx[row['annotation']]
-                    array[j] = max(array[j], row['bitscore'])
-            
-            cassette_arrays.append(array)
-            n_missings.append(n_miss)
+        features = registry.features(hmm)
         
-        if cassette_arrays:
-            scaler = joblib.load(os.path.join(models_dir, hmm + '_scaler.joblib'))
-            cassette_arrays = np.array(cassette_arrays)
+        if cassette_df.shape[0] > 0:
+            # one row per cassette (sorted by id, as in a groupby) and one column per feature,
+            # holding the best bitscore of the cassette's proteins annotated with that feature
+            cassette_idx, cassette_ids = pd.factorize(cassette_df['cassette_id'], sort=True)
+            feature_idx = pd.Index(features).get_indexer(cassette_df['annotation'].values)
+            unknown = (cassette_df['annotation'] == 'unknown').values
+            annotated = feature_idx >= 0
+
+            cassette_arrays = np.zeros((len(cassette_ids), len(features)))
+            np.maximum.at(cassette_arrays, (cassette_idx[annotated], feature_idx[annotated]), cassette_df['bitscore'].values[annotated])
+            n_missings = np.bincount(cassette_idx[unknown], minlength=len(cassette_ids))
+
+            scaler = registry.scaler(hmm)
             cassette_arrays = scaler.transform(cassette_arrays)
 
-            cassette_header = ' '.join(features)
-            cassette_file_path = os.path.join(cassette_output_dir, hmm + '_cassette_arrays.txt')
-            print('Saving cassette(s) to', cassette_file_path)
-            np.savetxt(os.path.join(cassette_output_dir, hmm + '_cassette_arrays.txt'), cassette_arrays, header=cassette_header)
+            if array_format:
+                save_cassette_arrays(cassette_arrays, os.path.join(cassette_output_dir, hmm + '_cassette_arrays.' + array_format))
 
             hmm_cassette_arrays[hmm] = cassette_arrays
             hmm_features[hmm] = features
-            hmm_missings[hmm] = n_missings
+            hmm_missings[hmm] = n_missings.tolist()
         else:
             print('CRISPRcasIdentifier could not find enough hits to build one or more cassettes for the input file and ', hmm, '.', sep='')
 
     return hmm_features, hmm_cassette_arrays, hmm_missings
 
-def predict_missings(models_dir, regressor, hmm_features, hmm_cassettes, hmm_missings):
-    filled_cassettes = defaultdict(list)
-    reg_name = REGRESSORS[regressor]
+def save_cassette_arrays(cassette_arrays, cassette_file_path):
+    # columns follow the order of the <hmm>_features.joblib model file
+    print('Saving cassette(s) to', cassette_file_path)
+
+    if cassette_file_path.endswith('.npz'):
+        scipy.sparse.save_npz(cassette_file_path, scipy.sparse.csr_matrix(cassette_arrays))
+    else:
+        np.save(cassette_file_path, cassette_arrays)
+
+def cassette_label(hmm_cassette_ids, hmm, i):
+    if hmm_cassette_ids is None:
+        return i + 1
+
+    genome, cassette_id = hmm_cassette_ids[hmm][i]
+    return '{} ({})'.format(cassette_id, genome)
 
+def predict_missings(registry, regressor, hmm_features, hmm_cassettes, hmm_missings, hmm_cassette_ids=None):
     print('\n' + '-' * 50)
+    return {hmm : predict_hmm_missings(registry, regressor, hmm, hmm_features, hmm_cassettes, hmm_missings, hmm_cassette_ids) for hmm in sorted(hmm_missings)}
 
-    for hmm in sorted(hmm_missings):
-        for id_, n_miss in enumerate(hmm_missings[hmm]):
-            cassette = np.copy(hmm_cassettes[hmm][id_])
-
-            if np.any(cassette > 0.0):
-                if n_miss == 0:
-                    print('There are no unlabeled proteins for cassette #', id_ + 1, 'and', hmm)
-                elif n_miss == 1:
-                    print('There is', n_miss, 'unlabeled protein for cassette #', id_ + 1, 'and', hmm)
-                else:
-                    print('There are', n_miss, 'unlabeled proteins for cassette #', id_ + 1, 'and', hmm)
-                
-                if n_miss > MAX_N_MISS:
-                    print('More than ' + str(MAX_N_MISS) + ' missing proteins. Regression predictions will likely be weak.')
+def predict_hmm_missings(registry, regressor, hmm, hmm_features, hmm_cassettes, hmm_missings, hmm_cassette_ids=None):
+    reg_name = REGRESSORS[regressor]
+    cassettes = hmm_cassettes[hmm]
+    n_missings = np.asarray(hmm_missings[hmm])
+    features = hmm_features[hmm]
+    non_empty = np.any(cassettes > 0.0, axis=1)
+    to_fill = (cassettes == 0.0) & (non_empty & (n_missings > 0))[:, np.newaxis]
+    predictions = np.full(cassettes.shape, -np.inf)
+
+    # one predict call per feature, over every cassette in which that feature is missing
+    for j in np.where(np.any(to_fill, axis=0))[0]:
+        rows = np.where(to_fill[:, j])[0]
+        predictions[rows, j] = registry.predict(hmm + '_' + reg_name + '_' + str(features[j]), np.delete(cassettes[rows], j, axis=1))
+
+    # features of each cassette sorted by decreasing prediction (ties keep the feature order),
+    # only the n_miss best ones are filled in
+    order = np.argsort(-predictions, axis=1, kind='stable')
+    ranks = np.argsort(order, axis=1, kind='stable')
+    n_predictions = np.minimum(n_missings, to_fill.sum(axis=1))
+    filled = to_fill & (ranks < n_predictions[:, np.newaxis]) & (predictions > 0.0)
+    filled_cassettes = np.where(filled, predictions, cassettes)
+
+    for id_, n_miss in enumerate(n_missings):
+        label = cassette_label(hmm_cassette_ids, hmm, id_)
+
+        if non_empty[id_]:
+            if n_miss == 0:
+                print('There are no unlabeled proteins for cassette #', label, 'and', hmm)
+            elif n_miss == 1:
+                print('There is', n_miss, 'unlabeled protein for cassette #', label, 'and', hmm)
+            else:
+                print('There are', n_miss, 'unlabeled proteins for cassette #', label, 'and', hmm)
+            
+            if n_miss > MAX_N_MISS:
+                print('More than ' + str(MAX_N_MISS) + ' missing proteins. Regression predictions will likely be weak.')
 
-                if n_miss:
-                    zeros_idx = np.where(cassette == 0.0)[0]
-                    features = hmm_features[hmm]
-                    features_to_test = features[zeros_idx]
+            for i, j in enumerate(order[id_, :n_predictions[id_]]):
+                if filled[id_, j]:
+                    print('{0} missing bitscore prediction for cassette #{1}, {2} and {3} ({4}/{5}): {6:.6f}'.format(regressor, label, hmm, features[j], i + 1, n_predictions[id_], predictions[id_, j]))
+        
+        else:
+            print('Cassette #' + str(label) + ' is either empty or composed only by unknown proteins for ' + hmm + '. '
+                  'Regressors are not able to predict anything.')
+        
+        print('-' * 50)
 
-                    predictions = []
+    return filled_cassettes
 
-                    for j, f in zip(zeros_idx, features_to_test):
-                        reg = joblib.load(os.path.join(models_dir, hmm + '_' + reg_name + '_' + f + '.joblib'))
-                        cassette_f = np.delete(cassette, j)
-                        pred = reg.predict(np.expand_dims(cassette_f, axis=0))[0]
-                        predictions.append((j, f, pred))
+def classify(registry, regressor_name, classifiers, hmm_cassettes, return_probability, hmm_missings, output_defaultdict, hmm_cassette_ids=None):
+    for hmm in sorted(hmm_cassettes):
+        classify_hmm(registry, regressor_name, classifiers, hmm, hmm_cassettes, return_probability, hmm_missings, output_defaultdict, hmm_cassette_ids)
+
+def classify_hmm(registry, regressor_name, classifiers, hmm, hmm_cassettes, return_probability, hmm_missings, output_defaultdict, hmm_cassette_ids=None):
+    cassettes = hmm_cassettes[hmm]
+    encoder = registry.encoder(hmm)
+    non_empty = np.any(cassettes > 0.0, axis=1)
+    clf_labels = {}
+
+    # each classifier runs once over all the non-empty cassettes of the HMM set (if there is any)
+    for clf_name in (classifiers if non_empty.any() else []):
+        if return_probability:
+            probs = registry.predict(hmm + '_' + clf_name, cassettes[non_empty], 'predict_proba')
+            order = np.argsort(-probs, axis=1, kind='stable')
+            class_names = encoder.inverse_transform(np.arange(probs.shape[1]))[order]
+            probs = np.take_along_axis(probs, order, axis=1)
+            n_classes = (probs > 0.0).sum(axis=1)
+            clf_labels[clf_name] = [list(zip(names[:n], p[:n])) for names, p, n in zip(class_names, probs, n_classes)]
+        else:
+            clf_labels[clf_name] = encoder.inverse_transform(registry.predict(hmm + '_' + clf_name, cassettes[non_empty]))
 
-                    predictions = sorted(predictions, key=lambda x : -x[-1])
-                    n_miss = min(n_miss, len(predictions))
+    if regressor_name:
+        print('Predictions for', hmm, 'and', regressor_name, 'regressor\n')
+    else:
+        print('Predictions for', hmm, 'without regression\n')
 
-                    for i in range(n_miss):
-                        j, f, pred = predictions[i]
+    # position of each non-empty cassette among the classified ones
+    clf_rows = np.cumsum(non_empty) - 1
 
-                        if pred > 0.0:
-                            print('{0} missing bitscore prediction for cassette #{1}, {2} and {3} ({4}/{5}): {6:.6f}'.format(regressor, id_ + 1, hmm, f, i + 1, n_miss, pred))
-                            cassette[j] = pred # because cassette is a 2d 1 x m array
-                
-                filled_cassettes[hmm].append(cassette)
-            
+    for ci, k in enumerate(clf_rows):
+        label = cassette_label(hmm_cassette_ids, hmm, ci)
+
+        if not non_empty[ci]:
+            print('Cassette #' + str(label) + ' is either empty or composed only by unknown proteins for ' + hmm + '. '
+                  'Classifiers are not able to predict anything.')
+            continue
+
+        if not regressor_name and hmm_missings[hmm][ci] > MAX_N_MISS:
+            print('More than ' + str(MAX_N_MISS) + ' missing proteins. Classification predictions will likely be weak.')
+
+        for clf_name in classifiers:
+            # saving output information ------------------------
+            if hmm_cassette_ids is None:
+                output_defaultdict['HMM'].append(hmm)
+                output_defaultdict['cassette_id'].append(ci + 1)
             else:
-                print('Cassette #' + str(id_ + 1) + ' is either empty or composed only by unknown proteins for ' + hmm + '. '
-                      'Regressors are not able to predict anything.')
-            
-            print('-' * 50)
+                genome, cassette_id = hmm_cassette_ids[hmm][ci]
+                output_defaultdict['genome'].append(genome)
+                output_defaultdict['HMM'].append(hmm)
+                output_defaultdict['cassette_id'].append(cassette_id)
 
-    return filled_cassettes
+            output_defaultdict['classifier'].append(CLASSIFIERS_INV[clf_name])
 
-def classify(models_dir, regressor_name, classifiers, hmm_cassettes, return_probability, hmm_missings, output_defaultdict):
-    for hmm in sorted(hmm_cassettes):
-        cassette = hmm_cassettes[hmm]
-        encoder = joblib.load(os.path.join(models_dir, hmm + '_encoder.joblib'))
+            if regressor_name:
+                output_defaultdict['regressor'].append(regressor_name)
+            # --------------------------------------------------
+
+            pred_label = clf_labels[clf_name][k]
+
+            if return_probability:
+                prob_str = ', '.join('{0} ({1:.3f})'.format(name, prob) for name, prob in pred_label)
+                print('Cassette #{} -- {} classifier: {}'.format(label, CLASSIFIERS_INV[clf_name], prob_str))
+            else:
+                print('Cassette #{} -- {} classifier: {}'.format(label, CLASSIFIERS_INV[clf_name], pred_label))
+                
+            output_defaultdict['predicted_label'].append(pred_label)
+
+        print()
+
+    print('-' * 50)
+
+def find_fasta_files(batch):
+    # batch can be a directory, a glob pattern or a manifest file with one "path" or "sample<TAB>path" per line
+    if os.path.isdir(batch):
+        fasta_files = sorted(p for p in glob.glob(os.path.join(batch, '*')) if p.lower().endswith(INPUT_EXTENSIONS))
+        samples = [(fasta_sample_name(p), p) for p in fasta_files]
+
+    elif os.path.isfile(batch):
+        manifest_dir = os.path.dirname(batch)
+        samples = []
+
+        with open(batch, 'r') as f:
+            for line in f:
+                line = line.strip()
+
+                if line and not line.startswith('#'):
+                    fields = line.split('\t')
+                    path = fields[-1].strip()
+
+                    if not os.path.isabs(path):
+                        path = os.path.join(manifest_dir, path)
+
+                    sample = fields[0].strip() if len(fields) > 1 else fasta_sample_name(path)
+                    samples.append((sample, path))
+
+    else:
+        samples = [(fasta_sample_name(p), p) for p in sorted(glob.glob(batch))]
+
+    if not samples:
+        raise FileNotFoundError('No fasta files found for {}'.format(batch))
+
+    sample_counts = Counter(sample for sample, _ in samples)
+    duplicates = sorted(s for s, count in sample_counts.items() if count > 1)
+
+    if duplicates:
+        raise ValueError('Duplicated sample names in batch input: {}'.format(', '.join(duplicates)))
+
+    for _, path in samples:
+        if not os.path.exists(path):
+            raise FileNotFoundError('No such file {}'.format(path))
+
+    return samples
+
+def fasta_sample_name(fasta_file):
+    name = os.path.basename(strip_compressed_extension(fasta_file))
+
+    for ext in FASTA_EXTENSIONS:
+        if name.lower().endswith(ext):
+            return name[:-len(ext)]
+
+    return name.rsplit('.', 1)[0]
+
+def build_cassette_arrays(fasta_file, args, registry, hmmsearch_output_dir, cassette_output_dir, prodigal_output_dir=None, hit_cache=None, checkpoint=None):
+    # with a checkpoint (see run_manifest.py), the stages finished in a previous run are not run again
+    if checkpoint and checkpoint.done('annotation'):
+        print('Cassettes restored from checkpoint')
+        return checkpoint.load('annotation')
+
+    protein_df, hmm_hits = search_genome(fasta_file, args, hmmsearch_output_dir, cassette_output_dir, prodigal_output_dir, hit_cache, checkpoint)
+    return annotate_genome(protein_df, hmm_hits, args, registry, hmmsearch_output_dir, cassette_output_dir, checkpoint)
+
+def search_genome(fasta_file, args, hmmsearch_output_dir, cassette_output_dir, prodigal_output_dir=None, hit_cache=None, checkpoint=None):
+    # prodigal and hmmsearch, the stages that mostly wait for external tools
+    if not os.path.exists(cassette_output_dir):
+        Path(cassette_output_dir).mkdir(parents=True, exist_ok=True)
+    
+    if not os.path.exists(hmmsearch_output_dir):
+        Path(hmmsearch_output_dir).mkdir(parents=True, exist_ok=True)
+
+    # with args.incremental, the results of prodigal and of the search of each HMM set are kept in the hmmsearch
+    # output folder along with the fingerprint of their inputs, and reused by later runs with the same inputs
+    stamps = StageStamps(hmmsearch_output_dir) if args.incremental else None
+    
+    if args.sequence_type == 'dna' and checkpoint and checkpoint.done('prodigal') and os.path.exists(checkpoint.load('prodigal')):
+        fasta_file = checkpoint.load('prodigal')
+        print('Proteins restored from checkpoint ({})'.format(fasta_file))
+
+    elif args.sequence_type == 'dna':
+        prodigal_key = fingerprint('prodigal', file_digest(fasta_file), args.sequence_completeness) if stamps else None
+        proteins = stamps.load('prodigal', prodigal_key) if stamps else None
+
+        if proteins and os.path.exists(proteins[0]) and file_digest(proteins[0]) == proteins[1]:
+            fasta_file = proteins[0]
+            print('Proteins up to date ({})'.format(fasta_file))
 
-        if regressor_name:
-            print('Predictions for', hmm, 'and', regressor_name, 'regressor\n')
         else:
-            print('Predictions for', hmm, 'without regression\n')
+            print('Running prodigal on DNA sequences')
 
-        for ci, casc in enumerate(cassette):
-            if np.any(casc > 0.0):
-                if not regressor_name and hmm_missings[hmm][ci] > MAX_N_MISS:
-                    print('More than ' + str(MAX_N_MISS) + ' missing proteins. Classification predictions will likely be weak.')
+            with metrics.stage('prodigal'):
+                fasta_file = prodigal(PRODIGAL, fasta_file, args.sequence_completeness, prodigal_output_dir, args.threads)
 
-                casc = np.expand_dims(casc, axis=0)
-                
-                for clf_name in classifiers:
-                    # saving output information ------------------------
-                    output_defaultdict['HMM'].append(hmm)
-                    output_defaultdict['cassette_id'].append(ci + 1)
-                    output_defaultdict['classifier'].append(CLASSIFIERS_INV[clf_name])
-
-                    if regressor_name:
-                        output_defaultdict['regressor'].append(regressor_name)
-                    # --------------------------------------------------
-
-                    clf = joblib.load(os.path.join(models_dir, hmm + '_' + clf_name + '.joblib'))
-
-                    if return_probability:
-                        pred = clf.predict_proba(casc)
-                        pred_class_idx = np.where(pred > 0.0)
-                        pred_class_names = encoder.inverse_transform(pred_class_idx[1])
-                        pred_probs = pred[pred_class_idx]
-                        sorted_idx = np.argsort(-pred_probs)
-                        prob_str = ', '.join('{0} ({1:.3f})'.format(name, prob) for name, prob in zip(pred_class_names[sorted_idx], pred_probs[sorted_idx]))
-                        print('Cassette #{} -- {} classifier: {}'.format(ci + 1, CLASSIFIERS_INV[clf_name], prob_str))
-
-                        pred_label = list(zip(pred_class_names[sorted_idx], pred_probs[sorted_idx]))
-                    else:
-                        pred = clf.predict(casc)
-                        pred_label = encoder.inverse_transform(pred)[0]
-                        print('Cassette #{} -- {} classifier: {}'.format(ci + 1, CLASSIFIERS_INV[clf_name], pred_label))
-                    
-                    output_defaultdict['predicted_label'].append(pred_label)
-
-                print()
-            
+            if stamps:
+                stamps.save('prodigal', prodigal_key, (fasta_file, file_digest(fasta_file)))
+
+        if checkpoint:
+            checkpoint.save('prodigal', fasta_file)
+
+    with metrics.stage('protein_table'):
+        protein_df = build_initial_dataframe(fasta_file, args.sequence_type)
+
+    metrics.count('proteins', protein_df.shape[0])
+
+    if checkpoint and checkpoint.done('hmmsearch'):
+        print('hmmsearch hits restored from checkpoint')
+        hmm_hits = checkpoint.load('hmmsearch')
+
+    else:
+        with metrics.stage('hmmsearch'):
+            hmm_hits = search_hits(fasta_file, args, protein_df, hmmsearch_output_dir, hit_cache, stamps)
+
+        if checkpoint:
+            checkpoint.save('hmmsearch', hmm_hits)
+
+    for hmm in args.hmm_sets:
+        metrics.count('hits/' + hmm, (hmm_hits[hmm]['bitscore'] > 0.0).sum())
+
+    return protein_df, hmm_hits
+
+def annotate_genome(protein_df, hmm_hits, args, registry, hmmsearch_output_dir, cassette_output_dir, checkpoint=None):
+    # with args.incremental, the cassette arrays of each HMM set are kept in the cassette output folder, and only
+    # the HMM sets whose proteins, hits or feature and scaler models changed are annotated again
+    hmm_sets = args.hmm_sets
+    cached_arrays = {}
+
+    if args.incremental:
+        stamps = StageStamps(cassette_output_dir)
+        protein_digest = frame_digest(protein_df)
+        cassette_keys = {hmm : fingerprint('cassettes', protein_digest, frame_digest(hmm_hits[hmm]), args.sequence_type, args.cassette_arrays,
+                                           registry.version(hmm + '_features'), registry.version(hmm + '_scaler')) for hmm in hmm_sets}
+
+        for hmm in hmm_sets:
+            hmm_arrays = stamps.load('cassettes_' + hmm, cassette_keys[hmm])
+
+            if hmm_arrays is not None:
+                cached_arrays[hmm] = hmm_arrays
+
+        if cached_arrays:
+            print('Cassettes of {} up to date'.format(', '.join(hmm for hmm in hmm_sets if hmm in cached_arrays)))
+
+        hmm_sets = [hmm for hmm in hmm_sets if hmm not in cached_arrays]
+
+    arrays = build_hmm_cassette_arrays(protein_df, hmm_hits, hmm_sets, args, registry, hmmsearch_output_dir, cassette_output_dir) if hmm_sets else ({}, {}, {})
+
+    if args.incremental:
+        for hmm in hmm_sets:
+            # (features, cassettes, missings) of hmm, all None if it has no cassettes
+            cached_arrays[hmm] = tuple(hmm_arrays.get(hmm) for hmm_arrays in arrays)
+            stamps.save('cassettes_' + hmm, cassette_keys[hmm], cached_arrays[hmm])
+
+        # the HMM sets are put back in the order of args.hmm_sets
+        arrays = tuple({hmm : cached_arrays[hmm][i] for hmm in args.hmm_sets if cached_arrays[hmm][i] is not None} for i in range(3))
+
+    if checkpoint:
+        checkpoint.save('annotation', arrays)
+
+    return arrays
+
+def build_hmm_cassette_arrays(protein_df, hmm_hits, hmm_sets, args, registry, hmmsearch_output_dir, cassette_output_dir):
+    print('Annotating proteins')
+
+    with metrics.stage('annotation'):
+        annotated_protein_dfs = annotate_proteins(protein_df, hmmsearch_output_dir, hmm_sets, args.sequence_type, cassette_output_dir, save_csv=True, hmm_hits=hmm_hits)
+
+    print('Building cassettes')
+
+    with metrics.stage('cassettes'):
+        hmm_cassettes = build_cassettes(annotated_protein_dfs, args.sequence_type, cassette_output_dir=cassette_output_dir, save_csv=True, n_jobs=args.threads or 1)
+
+    for hmm, cassette_df in hmm_cassettes.items():
+        metrics.count('cassettes/' + hmm, cassette_df['cassette_id'].nunique())
+
+    with metrics.stage('cassette_arrays'):
+        return convert_cassette_dataframes_to_numpy_arrays(hmm_cassettes, registry, cassette_output_dir, args.cassette_arrays)
+
+def search_hits(fasta_file, args, protein_df, hmmsearch_output_dir, hit_cache=None, stamps=None):
+    # with stamps, only the HMM sets whose hits are not up to date are searched
+    if not stamps:
+        return search_hmm_sets(fasta_file, args, protein_df, hmmsearch_output_dir, hit_cache)
+
+    protein_digest = file_digest(fasta_file)
+    search_keys = {hmm : fingerprint('hmmsearch', protein_digest, hit_cache_key(hmm, 1000, HIT_CACHE_TARGETS if hit_cache else None), args.sequence_type, args.two_stage_search and args.sequence_type == 'dna') for hmm in args.hmm_sets}
+    hmm_hits = {}
+
+    for hmm in args.hmm_sets:
+        hits = stamps.load('hmmsearch_' + hmm, search_keys[hmm])
+
+        if hits is not None:
+            hmm_hits[hmm] = hits
+
+    if hmm_hits:
+        print('hmmsearch hits of {} up to date'.format(', '.join(hmm for hmm in args.hmm_sets if hmm in hmm_hits)))
+
+    search_args = Namespace(**vars(args))
+    search_args.hmm_sets = [hmm for hmm in args.hmm_sets if hmm not in hmm_hits]
+
+    if search_args.hmm_sets:
+        for hmm, hits in search_hmm_sets(fasta_file, search_args, protein_df, hmmsearch_output_dir, hit_cache).items():
+            stamps.save('hmmsearch_' + hmm, search_keys[hmm], hits)
+            hmm_hits[hmm] = hits
+
+    return hmm_hits
+
+def search_hmm_sets(fasta_file, args, protein_df, hmmsearch_output_dir, hit_cache=None):
+    if hit_cache:
+        return search_with_hit_cache(fasta_file, args, hit_cache, hmmsearch_output_dir)
+
+    if args.two_stage_search and args.sequence_type == 'dna':
+        return two_stage_search(fasta_file, args, protein_df, hmmsearch_output_dir)
+
+    print('Running hmmsearch' + raw_output_message(args, hmmsearch_output_dir))
+    hmm_database_dir = HMM_DB_DIR if args.hmm_database else None
+    tab_files = hmmsearch(HMMSEARCH, fasta_file, HMM_DIR, args.hmm_sets, hmmsearch_output_dir, database_dir=hmm_database_dir, shards=args.hmm_shards, threads=args.threads, raw_output=args.hmmsearch_raw_output, keep_archived=args.incremental)
+    return {hmm : parse_hmmsearch_hits(tab_files[hmm], args.sequence_type) for hmm in args.hmm_sets}
+
+def raw_output_message(args, hmmsearch_output_dir):
+    if args.hmmsearch_raw_output == 'files':
+        return ' (log and outputs stored in {})'.format(hmmsearch_output_dir)
+    elif args.hmmsearch_raw_output == 'archive':
+        return ' (log and outputs archived in {})'.format(os.path.join(hmmsearch_output_dir, HMMSEARCH_ARCHIVE))
+
+    return ''
+
+def hit_cache_key(hmm, cutoff, n_targets=None):
+    # hits are only reused for the same HMM set files, hmmsearch E-value cutoff and number of target sequences. The
+    # fingerprint is computed again on every search, so that HMM sets updated under a running server are seen.
+    return '{}-{}-E{}-Z{}'.format(hmm, hmm_set_fingerprint(os.path.join(HMM_DIR, hmm)), cutoff, n_targets or 'all')
+
+def search_with_hit_cache(fasta_file, args, hit_cache, hmmsearch_output_dir, cutoff=1000, n_targets=HIT_CACHE_TARGETS):
+    protein_hashes = {}
+    records = {}
+
+    for id_, header, sequence in read_protein_sequences(fasta_file, args.sequence_type):
+        seq_hash = hashlib.md5(sequence.upper().rstrip('*').encode()).hexdigest()
+        protein_hashes.setdefault(id_, seq_hash)
+        records.setdefault(seq_hash, (header, sequence))
+
+    cache_keys = {hmm : hit_cache_key(hmm, cutoff, n_targets) for hmm in args.hmm_sets}
+    cached_hits = {}
+    searched = set()
+
+    for hmm in args.hmm_sets:
+        cached_hits[hmm], found = hit_cache.lookup(cache_keys[hmm], records)
+        searched.update(seq_hash for seq_hash in records if seq_hash not in found)
+
+    if searched:
+        # only one copy of each sequence missing from the cache (for any of the HMM sets) is searched
+        uncached_fasta_file = os.path.join(hmmsearch_output_dir, 'uncached_proteins.fa')
+
+        with open(uncached_fasta_file, 'w') as f:
+            for seq_hash in searched:
+                header, sequence = records[seq_hash]
+                f.write(header + sequence + '\n')
+
+        print('Running hmmsearch on {} of {} unique protein sequence(s) not found in the hit cache'.format(len(searched), len(records)) + raw_output_message(args, hmmsearch_output_dir))
+        hmm_database_dir = HMM_DB_DIR if args.hmm_database else None
+        tab_files = hmmsearch(HMMSEARCH, uncached_fasta_file, HMM_DIR, args.hmm_sets, hmmsearch_output_dir, cutoff=cutoff, database_dir=hmm_database_dir, shards=args.hmm_shards, threads=args.threads, raw_output=args.hmmsearch_raw_output, keep_archived=args.incremental, n_targets=n_targets)
+    else:
+        print('All {} unique protein sequence(s) found in the hit cache'.format(len(records)))
+
+    # object columns even without any protein, for the merge with the hits
+    proteins = pd.DataFrame({'protein' : list(protein_hashes), 'seq_hash' : list(protein_hashes.values())}, dtype=object)
+    hmm_hits = {}
+
+    for hmm in args.hmm_sets:
+        hits = cached_hits[hmm]
+
+        if searched:
+            new_hits = parse_hmmsearch_hits(tab_files[hmm], args.sequence_type)
+            new_hits = new_hits[new_hits['bitscore'] > 0.0]
+            new_hits = new_hits.assign(seq_hash=new_hits['protein'].map(protein_hashes))
+            hit_cache.store(cache_keys[hmm], searched, new_hits)
+            hits = pd.concat([hits, new_hits[['seq_hash', 'annotation', 'bitscore']]], ignore_index=True)
+
+        hmm_hits[hmm] = proteins.merge(hits, on='seq_hash')[['protein', 'annotation', 'bitscore']]
+        cache_hits, cache_misses = hit_cache.stats(cache_keys[hmm])
+        print('Hit cache for {}: {} sequence(s) reused, {} searched (all runs: {} reused, {} searched)'.format(hmm, len(records) - len(searched), len(searched), cache_hits, cache_misses))
+
+    return hmm_hits
+
+def two_stage_search(fasta_file, args, protein_df, hmmsearch_output_dir, cutoff=1000, max_gap=MAX_GAP):
+    # Every cassette has a protein annotated with a CORE gene and its other proteins are chained to it with at most
+    # max_gap unknown proteins in between. So CORE profiles are searched against all proteins first, and the other
+    # profiles only against the proteins up to max_gap + 1 positions away (in the same contig) from a protein with a
+    # hit, until no new protein gets a hit. The cassettes found are the same as with a search of every profile, as
+    # every search computes its E-values for all the proteins of the file. max_gap is the one of build_cassettes.
+    core_profiles, other_profiles = {}, {}
+
+    for hmm in args.hmm_sets:
+        annotations = {hmm_f : profile_annotation(hmm_f) for hmm_f in os.listdir(os.path.join(HMM_DIR, hmm))}
+        core_profiles[hmm] = [hmm_f for hmm_f, annotation in annotations.items() if annotation in CORE]
+        other_profiles[hmm] = [hmm_f for hmm_f, annotation in annotations.items() if annotation and annotation not in CORE]
+
+    # the windows are read from the protein fasta file through its index, at the first record of each protein
+    index = fasta_index(fasta_file)
+    n_targets = len(index.headers)
+    first_records = {}
+
+    for i, header in enumerate(index.headers):
+        first_records.setdefault(header_protein_id(header, args.sequence_type), i)
+
+    hmm_database_dir = HMM_DB_DIR if args.hmm_database else None
+    stage_output_dir = os.path.join(hmmsearch_output_dir, 'stage1')
+    print('Running hmmsearch with the core gene profiles' + raw_output_message(args, stage_output_dir))
+    tab_files = hmmsearch(HMMSEARCH, fasta_file, HMM_DIR, args.hmm_sets, stage_output_dir, cutoff=cutoff, database_dir=hmm_database_dir, shards=args.hmm_shards, threads=args.threads, profiles=core_profiles, profile_set='core', raw_output=args.hmmsearch_raw_output, keep_archived=args.incremental, n_targets=n_targets)
+
+    hmm_hits = defaultdict(list)
+    positions = pd.Series(np.arange(protein_df.shape[0]), index=protein_df.index)
+    contig_codes = pd.factorize(protein_df['contig'])[0]
+    searched = np.zeros(protein_df.shape[0], dtype=bool)
+    stage = 1
+
+    while True:
+        # the windows of all HMM sets are searched together, a protein with a hit in any set widens them
+        known = np.zeros(protein_df.shape[0], dtype=bool)
+
+        for hmm in args.hmm_sets:
+            hits = parse_hmmsearch_hits(tab_files[hmm], args.sequence_type)
+            hmm_hits[hmm].append(hits)
+            known[positions[hits.loc[hits['bitscore'] > 0.0, 'protein']].values] = True
+
+        window = np.zeros(protein_df.shape[0], dtype=bool)
+        known_positions = np.flatnonzero(known)
+
+        for offset in range(-max_gap - 1, max_gap + 2):
+            neighbours = known_positions + offset
+            neighbours = neighbours[(neighbours >= 0) & (neighbours < protein_df.shape[0])]
+            window[neighbours[contig_codes[neighbours] == contig_codes[neighbours - offset]]] = True
+
+        window &= ~searched
+
+        if not window.any():
+            break
+
+        searched |= window
+        stage += 1
+        window_fasta_file = os.path.join(hmmsearch_output_dir, 'stage{}_proteins.fa'.format(stage))
+
+        with open(window_fasta_file, 'wb') as f:
+            for block in index.fetch(first_records[id_] for id_ in protein_df.index[window]):
+                f.write(block)
+
+        stage_output_dir = os.path.join(hmmsearch_output_dir, 'stage{}'.format(stage))
+        print('Running hmmsearch with the other profiles on {} protein(s) near hits'.format(window.sum()) + raw_output_message(args, stage_output_dir))
+        tab_files = hmmsearch(HMMSEARCH, window_fasta_file, HMM_DIR, args.hmm_sets, stage_output_dir, cutoff=cutoff, database_dir=hmm_database_dir, shards=args.hmm_shards, threads=args.threads, profiles=other_profiles, profile_set='other', raw_output=args.hmmsearch_raw_output, keep_archived=args.incremental, n_targets=n_targets)
+
+    print('Two-stage search: other profiles searched on {} of {} protein(s)'.format(searched.sum(), protein_df.shape[0]))
+    return {hmm : pd.concat(hits, ignore_index=True) for hmm, hits in hmm_hits.items()}
+
+def stack_cassette_arrays(genome_arrays):
+    # merges the cassettes of several genomes, so that every model runs once over all of them
+    hmm_features, hmm_cassettes, hmm_missings, hmm_cassette_ids = {}, defaultdict(list), defaultdict(list), defaultdict(list)
+
+    for genome, (features, cassettes, missings) in genome_arrays:
+        for hmm in cassettes:
+            hmm_features[hmm] = features[hmm]
+            hmm_cassettes[hmm].append(cassettes[hmm])
+            hmm_missings[hmm].extend(missings[hmm])
+            hmm_cassette_ids[hmm].extend((genome, ci + 1) for ci in range(len(missings[hmm])))
+
+    hmm_cassettes = {hmm : np.vstack(arrays) for hmm, arrays in hmm_cassettes.items()}
+    return hmm_features, hmm_cassettes, dict(hmm_missings), dict(hmm_cassette_ids)
+
+def run_batch(args, registry, samples, writer, hit_cache=None, manifest=None):
+    # with a manifest, every genome resumes from its last finished stage, genomes that fail are recorded and skipped,
+    # and the predictions are written genome by genome, in the order of samples. With args.pipeline_depth, the stages
+    # of consecutive genomes overlap (see pipeline.py)
+    predictor = BatchPredictor(args, registry, writer, manifest)
+    genomes = ({'sample' : sample, 'fasta_file' : fasta_file, 'position' : '{}/{}'.format(i + 1, len(samples))} for i, (sample, fasta_file) in enumerate(samples))
+    stages = [lambda genome : search_stage(args, genome, hit_cache, manifest), lambda genome : cassette_stage(args, registry, genome, manifest), predictor.add]
+
+    if args.pipeline_depth:
+        run_pipeline(genomes, stages, args.pipeline_depth)
+    else:
+        for genome in genomes:
+            for stage in stages:
+                genome = stage(genome)
+
+    predictor.predict()
+
+def search_stage(args, genome, hit_cache=None, manifest=None):
+    sample = genome['sample']
+    print('\n' + '=' * 50)
+    print('Genome {} ({}): {}'.format(sample, genome['position'], genome['fasta_file']))
+    print('=' * 50)
+
+    checkpoint = genome['checkpoint'] = manifest.genome(sample) if manifest else None
+
+    if checkpoint and checkpoint.done('prediction'):
+        print('Predictions restored from checkpoint')
+        genome['restored'] = True
+
+    elif checkpoint and checkpoint.done('annotation'):
+        print('Cassettes restored from checkpoint')
+        genome['arrays'] = checkpoint.load('annotation')
+
+    else:
+        sample_hmmsearch_output_dir = os.path.join(args.hmmsearch_output_dir, sample)
+
+        with recording_failure(genome, manifest):
+            genome['hits'] = search_genome(genome['fasta_file'], args, sample_hmmsearch_output_dir, os.path.join(args.cassette_output_dir, sample), sample_hmmsearch_output_dir, hit_cache, checkpoint)
+
+    return genome
+
+def cassette_stage(args, registry, genome, manifest=None):
+    if 'hits' in genome:
+        sample = genome['sample']
+
+        if args.pipeline_depth:
+            print('\nGenome {} ({}): cassettes'.format(sample, genome['position']))
+
+        with recording_failure(genome, manifest):
+            genome['arrays'] = annotate_genome(*genome.pop('hits'), args, registry, os.path.join(args.hmmsearch_output_dir, sample), os.path.join(args.cassette_output_dir, sample), genome['checkpoint'])
+
+    return genome
+
+@contextmanager
+def recording_failure(genome, manifest=None):
+    # with a manifest, a genome that fails is recorded and skipped instead of stopping the run
+    try:
+        yield
+    except Exception as e:
+        if not manifest:
+            raise
+
+        print('Failed ({}: {}), skipping {}'.format(type(e).__name__, e, genome['sample']))
+        manifest.fail(genome['sample'], e)
+
+class BatchPredictor:
+    # Collects the cassette arrays of the genomes of a batch, in order, and predicts the cassettes of every group of
+    # args.batch_group genomes (all of them by default) together.
+
+    def __init__(self, args, registry, writer, manifest=None):
+        self.args = args
+        self.registry = registry
+        self.writer = writer
+        self.manifest = manifest
+        self.genome_arrays = []
+        self.n_pending = 0
+
+    def add(self, genome):
+        if genome.get('restored'):
+            self.genome_arrays.append((genome['sample'], None))
+
+        elif 'arrays' in genome:
+            self.genome_arrays.append((genome['sample'], genome['arrays']))
+            self.n_pending += 1
+
+        if self.n_pending == self.args.batch_group:
+            self.predict()
+
+    def predict(self):
+        if self.genome_arrays:
+            predict_genome_group(self.args, self.registry, self.genome_arrays, self.writer, self.manifest)
+
+        self.genome_arrays = []
+        self.n_pending = 0
+
+def checkpoint_options(args):
+    # options the checkpoints of a manifest depend on
+    return {'sequence_type' : args.sequence_type, 'sequence_completeness' : args.sequence_completeness, 'hmm_sets' : args.hmm_sets, 'run_mode' : args.run_mode,
+            'regressors' : args.regressors, 'classifiers' : args.classifiers, 'probability' : args.probability}
+
+def predict_genome_group(args, registry, genome_arrays, writer, manifest=None):
+    # genome_arrays: (sample, cassette arrays) pairs, arrays are None for genomes already predicted in the manifest
+    if not manifest:
+        predict_cassettes(args, registry, *stack_cassette_arrays(genome_arrays), writer=writer)
+        writer.flush()
+        return
+
+    try:
+        genome_rows = predict_genome_rows(args, registry, [(sample, arrays) for sample, arrays in genome_arrays if arrays is not None])
+    except Exception as e:
+        # the genomes are predicted again one at a time, so that only those that fail are recorded and skipped
+        print('Prediction of the group failed ({}: {}), predicting its genomes one at a time'.format(type(e).__name__, e))
+        genome_rows = None
+
+    for sample, arrays in genome_arrays:
+        checkpoint = manifest.genome(sample)
+        rows = None
+
+        with recording_failure({'sample' : sample}, manifest):
+            if arrays is None:
+                rows = checkpoint.load('prediction')
             else:
-                print('Cassette #' + str(ci + 1) + ' is either empty or composed only by unknown proteins for ' + hmm + '. '
-                      'Classifiers are not able to predict anything.')
+                rows = (genome_rows if genome_rows is not None else predict_genome_rows(args, registry, [(sample, arrays)])).get(sample, {})
+                checkpoint.save('prediction', rows)
 
-        print('-' * 50)
+        if rows is not None:
+            writer.write(rows)
+
+    writer.flush()
+
+def predict_genome_rows(args, registry, genome_arrays):
+    return split_rows_by_genome(predict_cassettes(args, registry, *stack_cassette_arrays(genome_arrays)))
+
+def split_rows_by_genome(output_defaultdict):
+    columns = list(output_defaultdict)
+    genome_rows = {}
+
+    for values in zip(*(output_defaultdict[c] for c in columns)):
+        rows = genome_rows.setdefault(values[columns.index('genome')], {c : [] for c in columns})
+
+        for column, value in zip(columns, values):
+            rows[column].append(value)
+
+    return genome_rows
+
+def predict_cassettes(args, registry, hmm_features, hmm_cassettes, hmm_missings, hmm_cassette_ids=None, writer=None):
+    # with a writer, the predictions are handed to it (and taken out of output_defaultdict) as soon as each HMM set is classified
+    classifiers = [CLASSIFIERS[clf] for clf in args.classifiers]
+    output_defaultdict = defaultdict(list)
+    n_pipelines = len(hmm_cassettes) * (1 if args.run_mode == 'classification' else len(args.regressors))
+
+    if hmm_cassettes and args.threads and args.threads > 1 and n_pipelines > 1:
+        with metrics.stage('prediction_pipelines'):
+            predict_cassettes_in_parallel(args, registry, hmm_features, hmm_cassettes, hmm_missings, output_defaultdict, hmm_cassette_ids, writer)
+
+    elif hmm_cassettes:
+        if args.run_mode == 'classification':
+            print('Loading classifiers and running classification')
+
+            with metrics.stage('classification'):
+                for hmm in sorted(hmm_cassettes):
+                    classify_hmm(registry, '', classifiers, hmm, hmm_cassettes, args.probability, hmm_missings, output_defaultdict, hmm_cassette_ids)
+
+                    if writer:
+                        writer.write(output_defaultdict)
+
+        else:
+            for reg in args.regressors:
+                with metrics.stage('regression/' + reg):
+                    hmm_cassettes_reg = predict_missings(registry, reg, hmm_features, hmm_cassettes, hmm_missings, hmm_cassette_ids)
+
+                if args.run_mode == 'combined':
+                    print('Loading classifiers and running classification')
+
+                    with metrics.stage('classification/' + reg):
+                        for hmm in sorted(hmm_cassettes_reg):
+                            classify_hmm(registry, reg, classifiers, hmm, hmm_cassettes_reg, args.probability, hmm_missings, output_defaultdict, hmm_cassette_ids)
+
+                            if writer:
+                                writer.write(output_defaultdict)
+
+    return output_defaultdict
+
+def predict_cassettes_in_parallel(args, registry, hmm_features, hmm_cassettes, hmm_missings, output_defaultdict, hmm_cassette_ids=None, writer=None):
+    # Each (HMM set, regressor) pipeline runs in a process of its own. Their logs and predictions are merged in the
+    # order of a sequential run: regressors as given, HMM sets sorted by name.
+    hmms = sorted(hmm_cassettes)
+    regressors = [None] if args.run_mode == 'classification' else args.regressors
+    pipelines = [(hmm, reg) for reg in regressors for hmm in hmms]
+
+    with ProcessPoolExecutor(max_workers=min(args.threads, len(pipelines)), mp_context=process_pool_context(), initializer=init_worker_registry, initargs=(registry.models_dir, registry.max_bytes, registry.flat_models_dir, registry.memo_path)) as executor:
+        futures = [executor.submit(predict_pipeline, args, hmm, reg, {hmm : hmm_features[hmm]}, {hmm : hmm_cassettes[hmm]}, {hmm : hmm_missings[hmm]},
+                                   {hmm : hmm_cassette_ids[hmm]} if hmm_cassette_ids is not None else None) for hmm, reg in pipelines]
+        # pipelines are merged in order as soon as they finish
+        for i, reg in enumerate(regressors):
+            reg_results = [future.result() for future in futures[i * len(hmms):(i + 1) * len(hmms)]]
+
+            if reg is not None:
+                print('\n' + '-' * 50)
+                print(''.join(regression_log for regression_log, _, _, _ in reg_results), end='')
+
+            if args.run_mode != 'regression':
+                print('Loading classifiers and running classification')
+                print(''.join(classification_log for _, classification_log, _, _ in reg_results), end='')
+
+            for _, _, rows, worker_metrics in reg_results:
+                metrics.merge(worker_metrics)
+
+                for column, values in rows.items():
+                    output_defaultdict[column].extend(values)
+
+            if writer:
+                writer.write(output_defaultdict)
+
+worker_registry = None
+
+def init_worker_registry(models_dir, max_bytes, flat_models_dir=None, memo_path=None):
+    global worker_registry
+    worker_registry = ModelRegistry(models_dir, max_bytes, flat_models_dir, memo_path)
+    # a forked worker starts with a copy of the main process metrics, which must not be counted twice
+    metrics.take()
+
+def predict_pipeline(args, hmm, reg, hmm_features, hmm_cassettes, hmm_missings, hmm_cassette_ids=None):
+    # runs in a worker process: regression with reg (unless None) and classification for one HMM set,
+    # returning what they print, the prediction rows and the metrics recorded meanwhile (stages as in predict_cassettes)
+    classifiers = [CLASSIFIERS[clf] for clf in args.classifiers]
+    output_defaultdict = defaultdict(list)
+    regression_log, classification_log = io.StringIO(), io.StringIO()
+
+    if reg is not None:
+        with redirect_stdout(regression_log), metrics.stage('regression/' + reg):
+            hmm_cassettes = {hmm : predict_hmm_missings(worker_registry, reg, hmm, hmm_features, hmm_cassettes, hmm_missings, hmm_cassette_ids)}
+
+    if args.run_mode != 'regression':
+        with redirect_stdout(classification_log), metrics.stage('classification/' + reg if reg is not None else 'classification'):
+            classify_hmm(worker_registry, reg or '', classifiers, hmm, hmm_cassettes, args.probability, hmm_missings, output_defaultdict, hmm_cassette_ids)
+
+    return regression_log.getvalue(), classification_log.getvalue(), dict(output_defaultdict), metrics.take()
+
+SERVER_REQUEST_OPTIONS = {'sequence_type' : ['dna', 'protein'], 'sequence_completeness' : ['complete', 'partial'], 'run_mode' : ['classification', 'regression', 'combined'],
+                          'regressors' : list(REGRESSORS), 'classifiers' : list(CLASSIFIERS), 'hmm_sets' : ['HMM1', 'HMM2', 'HMM3', 'HMM4', 'HMM5', 'HMM2019'], 'probability' : [True, False]}
+
+def predict_payload(payload, args, registry, hit_cache=None):
+    # payload: {"fasta": "<fasta content>"} or {"path": "/path/to/file.fa"}, plus any of SERVER_REQUEST_OPTIONS
+    request_args = Namespace(**vars(args))
+    # every request works in a temporary directory, there is nothing to reuse
+    request_args.incremental = False
+
+    for option, value in payload.items():
+        if option in SERVER_REQUEST_OPTIONS:
+            values = to_list(value) if option in ('regressors', 'classifiers', 'hmm_sets') else [value]
+
+            if any(v not in SERVER_REQUEST_OPTIONS[option] for v in values):
+                raise ValueError('Invalid value for {}: {}'.format(option, value))
+
+            setattr(request_args, option, values if option in ('regressors', 'classifiers', 'hmm_sets') else value)
+
+        elif option not in ('fasta', 'path'):
+            raise ValueError('Unknown option {}'.format(option))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if 'fasta' in payload:
+            fasta_file = os.path.join(tmp_dir, 'input.fa')
+
+            with open(fasta_file, 'w') as f:
+                f.write(payload['fasta'])
+
+        elif 'path' in payload:
+            fasta_file = payload['path']
+
+            if not os.path.exists(fasta_file):
+                raise FileNotFoundError('No such file {}'.format(fasta_file))
+
+        else:
+            raise ValueError('Either fasta or path must be given')
+
+        hmmsearch_output_dir = os.path.join(tmp_dir, 'hmmsearch')
+        arrays = build_cassette_arrays(fasta_file, request_args, registry, hmmsearch_output_dir, os.path.join(tmp_dir, 'cassette'), hmmsearch_output_dir, hit_cache)
+        output_defaultdict = predict_cassettes(request_args, registry, *arrays)
+
+    return pd.DataFrame(output_defaultdict).to_dict('records')
 
 if __name__ == '__main__':
     from argparse import ArgumentParser
 
     parser = ArgumentParser()
     parser.add_argument('-f', '--fasta', dest='fasta_file', help='Fasta file path (it can be either protein or DNA, see -st and -sc for details).', metavar='/path/to/file.fa')
+    parser.add_argument('-b', '--batch', dest='batch', help='Batch of fasta files to process in a single run: a directory, a quoted glob pattern or a manifest file listing one fasta path (optionally preceded by a sample name and a tab) per line. Predictions of all genomes are saved together in the output file, with an additional genome column.', metavar='/path/to/dir')
+    parser.add_argument('-cp', '--checkpoint-dir', dest='checkpoint_dir', help='Directory where the progress of a batch run (see -b) is recorded in a manifest, along with the results of each finished stage (prodigal, hmmsearch, annotation and prediction) of every genome. Rerunning with the same directory resumes every genome from its last finished stage. Genomes that fail are recorded in the manifest and skipped (they are retried on the next run), and the predictions are written genome by genome.', metavar='/path/to/dir')
+    parser.add_argument('-bs', '--batch-shard', dest='batch_shard', type=shard_spec, help='Processes only the K-th of N contiguous parts of the batch (see -b), so that the parts can run independently (e.g. on different nodes, each with its own -o). Their prediction files are then joined with -ms.', metavar='K/N')
+    parser.add_argument('-ms', '--merge-shards', nargs='+', dest='merge_shards', help='Joins the prediction files of the shards of a batch (see -bs), in the given order, into the -o file, and exits.', metavar='/path/to/shard.csv')
+    parser.add_argument('-ic', '--incremental', dest='incremental', action='store_true', help='Whether to reuse the results of a previous run with the same output folders (-ho and -co): prodigal, the search of each HMM set and the cassettes of each HMM set are only run again if their inputs (fasta content, HMM set files, feature and scaler models, options) changed, and model outputs are memoised as with -pm.')
+    parser.add_argument('-pd', '--pipeline-depth', dest='pipeline_depth', type=int, help='Whether to overlap the stages of consecutive genomes of a batch (see -b): prodigal and hmmsearch run on the next genomes while the cassettes of the previous ones are built and predicted. At most N genomes wait between two stages (default: one genome at a time).', metavar='N')
     parser.add_argument('-r', '--regressors', nargs='+', dest='regressors', help='List of regressors. Available options: CART, ERT or SVM (default: ERT).', default='ERT', metavar='reg1 reg2', choices=['CART', 'ERT', 'SVM'])
     parser.add_argument('-c', '--classifiers', nargs='+', dest='classifiers', help='List of classifiers. Available options: CART, ERT or SVM (default: ERT).', default='ERT', metavar='clf1 clf2', choices=['CART', 'ERT', 'SVM'])
     parser.add_argument('-p', '--class-probabilities', dest='probability', action='store_true', help='Whether to return class probabilities.')
     parser.add_argument('-s', '--hmm-sets', nargs='+', dest='hmm_sets', help='List of HMM sets. Available options: HMM1 to HMM5 and HMM2019 (default: HMM2019).', metavar='HMMi HMMj', default='HMM2019', choices=['HMM1', 'HMM2', 'HMM3', 'HMM4', 'HMM5', 'HMM2019'])
+    parser.add_argument('-hd', '--hmm-database', dest='hmm_database', action='store_true', help='Whether to search each HMM set as one concatenated profile database (built once and cached in {}) instead of one hmmsearch call per profile.'.format(HMM_DB_DIR))
+    parser.add_argument('-hs', '--hmm-shards', dest='hmm_shards', type=int, default=1, help='Number of shards the profile database of each HMM set is split into (used only with -hd, default: 1).', metavar='N')
+    parser.add_argument('-t', '--threads', dest='threads', type=int, help='Number of CPU cores shared by the hmmsearch processes and used to run prodigal on chunks of contigs, build the cassettes of different contigs and run the (HMM set, regressor) prediction pipelines in parallel (default: one profile and one contig at a time, with hmmsearch\'s own threading defaults).', metavar='N')
+    parser.add_argument('-hc', '--hit-cache', dest='hit_cache', help='SQLite file used to cache the hmmsearch hits of each protein sequence (per HMM set version), so that only sequences not seen in previous runs are searched (default: no cache).', metavar='/path/to/cache.sqlite')
+    parser.add_argument('-hcs', '--hit-cache-size', dest='hit_cache_size', type=int, help='Maximum number of (protein sequence, HMM set) entries kept in the hit cache. The least recently used entries are evicted first (default: no limit).', metavar='N')
+    parser.add_argument('-ts', '--two-stage-search', dest='two_stage_search', action='store_true', help='Whether to search the core gene profiles against all proteins first and the other profiles only against the proteins near their hits (used only if sequence type is dna, not compatible with -hc). The cassettes found are the same as with the full search, but the annotated proteins outside cassettes may differ.')
     parser.add_argument('-ho', '--hmmsearch-output-dir', nargs='?', dest='hmmsearch_output_dir', help='hmmsearch output folder (default: ./output/hmmsearch).', default='./output/hmmsearch')
+    parser.add_argument('-hr', '--hmmsearch-raw-output', nargs='?', dest='hmmsearch_raw_output', help='What to do with the raw hmmsearch outputs (tblout and log of each profile), which are read directly from hmmsearch. Available options: files (stored in the hmmsearch output folder), archive (packed into one compressed archive in the hmmsearch output folder) or none (default: files).', default='files', metavar='raw_output', choices=['files', 'archive', 'none'])
     parser.add_argument('-co', '--cassette-output-dir', nargs='?', dest='cassette_output_dir', help='cassette output folder (default: ./output/cassette).', default='./output/cassette')
+    parser.add_argument('-ca', '--cassette-arrays', nargs='?', dest='cassette_arrays', help='Whether to save the scaled cassette feature arrays to the cassette output folder. Available options: npy (dense) or npz (sparse, compressed) (default: not saved).', metavar='format', choices=['npy', 'npz'])
     parser.add_argument('-st', '--sequence-type', nargs='?', dest='sequence_type', default='protein', help='Sequence type. Available options: dna or protein (default: protein).', metavar='seq_type', choices=['dna', 'protein'])
     parser.add_argument('-sc', '--sequence-completeness', nargs='?', dest='sequence_completeness', help='Sequence completeness (used only if sequence type is dna). Available options: complete or partial (default: complete).', default='complete', metavar='seq_comp', choices=['complete', 'partial'])
     parser.add_argument('-m', '--mode', nargs='?', dest='run_mode', help='Run mode. Available options: classification, regression or combined (default: combined).', default='combined', metavar='mode', choices=['classification', 'regression', 'combined'])
+    parser.add_argument('-pl', '--preload-models', dest='preload_models', action='store_true', help='Whether to load all the models needed by the selected HMM sets, regressors and classifiers before processing any input.')
+    parser.add_argument('-mm', '--model-memory', dest='model_memory', type=int, help='Maximum size (in MB, approximated by the size of the model files) of the models kept in memory. The least recently used models are dropped when it is exceeded (default: no limit).', metavar='MB')
+    parser.add_argument('-ft', '--flat-trees', dest='flat_trees', action='store_true', help='Whether to run the CART and ERT models from a flattened copy (NumPy arrays, memory-mapped and shared between processes) instead of the sklearn objects. The copy is made in {} the first time each model is used (or with flat_trees.py). Predictions are the same.'.format(FLAT_MODELS_DIR))
+    parser.add_argument('-pm', '--prediction-memo', dest='prediction_memo', help='SQLite file where the outputs of the regressors and classifiers are kept for every distinct cassette vector, so that vectors already seen (in this or previous runs) are not predicted again. It is created if it does not exist. Identical cassette vectors are predicted only once even without it.', metavar='/path/to/memo.sqlite')
+    parser.add_argument('--serve', dest='serve', help='Runs as a server that keeps the models loaded and answers prediction requests (POST /predict) on a local address, either host:port or the path of a Unix socket. The other options are used as defaults for every request.', metavar='address')
+    parser.add_argument('--server-workers', dest='server_workers', type=int, default=1, help='Number of requests processed at the same time in server mode (default: 1).', metavar='N')
+    parser.add_argument('--server-queue', dest='server_queue', type=int, default=16, help='Number of requests allowed to wait for a worker in server mode; further requests are rejected (default: 16).', metavar='N')
+    parser.add_argument('--metrics', dest='metrics', help='JSON file where the wall time, CPU time and peak memory of each stage (prodigal, hmmsearch per HMM set and per profile, annotation, cassettes, regression, classification) and the number of proteins, hits, cassettes and model loads are saved at the end of the run.', metavar='/path/to/metrics.json')
+    parser.add_argument('--cprofile', dest='cprofile', help='File where a cProfile dump of the run is saved (it can be read with pstats or snakeviz).', metavar='/path/to/run.prof')
     parser.add_argument('-o', '--output-file', nargs='?', dest='output_file', help='Where to store predictions (default: ./output/predictions.csv).', default='./output/predictions.csv')
+    parser.add_argument('-of', '--output-format', dest='output_format', help='Format of the predictions file. Available options: csv, jsonl, parquet (requires pyarrow) or sqlite (default: guessed from the -o extension, csv otherwise).', metavar='format', choices=['csv', 'jsonl', 'parquet', 'sqlite'])
+    parser.add_argument('-oc', '--output-chunk-size', dest='output_chunk_size', type=int, default=1000, help='Maximum number of predictions kept in memory before they are appended to the predictions file (default: 1000). The predictions of each HMM set and batch group are written as soon as they are made.', metavar='N')
+    parser.add_argument('-bg', '--batch-group', dest='batch_group', type=int, help='Number of genomes of a batch (see -b) whose cassettes are predicted together, after which their predictions are written (default: all the genomes of the batch).', metavar='N')
     args = parser.parse_args()
 
     args.regressors = to_list(args.regressors)
     args.classifiers = to_list(args.classifiers)
     args.hmm_sets = to_list(args.hmm_sets)
 
-    if not os.path.exists(args.fasta_file):
+    if args.merge_shards:
+        n_files = merge_prediction_files(args.merge_shards, args.output_file, args.output_format)
+        print('Predictions of {} shard(s) saved to {}'.format(n_files, args.output_file))
+        parser.exit()
+
+    if not args.fasta_file and not args.batch and not args.serve:
+        parser.error('one of -f, -b, -ms or --serve is required')
+
+    if (args.checkpoint_dir or args.batch_shard or args.pipeline_depth) and not args.batch:
+        parser.error('-cp, -bs and -pd require -b')
+
+    if args.two_stage_search and args.hit_cache:
+        parser.error('-ts and -hc cannot be used together')
+
+    if args.fasta_file and not os.path.exists(args.fasta_file):
         raise FileNotFoundError('No such file {}'.format(args.fasta_file))
 
     if not os.path.exists(HMM_DIR):
@@ -388,49 +1229,78 @@ if __name__ == '__main__':
 
     if not os.path.exists(MODELS_DIR):
         extract_targz(MODELS_TAR_GZ)
-    
-    if not os.path.exists(args.cassette_output_dir):
-        Path(args.cassette_output_dir).mkdir(parents=True, exist_ok=True)
-    
-    if not os.path.exists(args.hmmsearch_output_dir):
-        Path(args.hmmsearch_output_dir).mkdir(parents=True, exist_ok=True)
-    
+
     if args.sequence_type == 'dna':
-        print('Running prodigal on DNA sequences')
         cmd_exists(PRODIGAL + ' -h')
-        args.fasta_file = prodigal(PRODIGAL, args.fasta_file, args.sequence_completeness)
 
-    print('Running hmmsearch (log and outputs stored in {})'.format(args.hmmsearch_output_dir))
     cmd_exists(HMMSEARCH + ' -h')
-    hmmsearch(HMMSEARCH, args.fasta_file, HMM_DIR, args.hmm_sets, args.hmmsearch_output_dir)
 
-    print('Annotating proteins')
-    protein_df = build_initial_dataframe(args.fasta_file, args.sequence_type)
-    annotated_protein_dfs = annotate_proteins(protein_df, args.hmmsearch_output_dir, args.hmm_sets, args.sequence_type, args.cassette_output_dir, save_csv=True)
+    profiler = cProfile.Profile() if args.cprofile else None
 
-    print('Building cassettes')
-    hmm_cassettes = build_cassettes(annotated_protein_dfs, args.sequence_type, cassette_output_dir=args.cassette_output_dir, save_csv=True)
-    hmm_features, hmm_cassettes, hmm_missings = convert_cassette_dataframes_to_numpy_arrays(hmm_cassettes, MODELS_DIR, args.cassette_output_dir)
+    if profiler:
+        profiler.enable()
 
-    classifiers = [CLASSIFIERS[clf] for clf in args.classifiers]
-    output_defaultdict = defaultdict(list)
+    model_memory = args.model_memory * 1024 ** 2 if args.model_memory else None
+    prediction_memo = args.prediction_memo
 
-    if hmm_cassettes:
-        if args.run_mode == 'classification':
-            print('Loading classifiers and running classification')
-            classify(MODELS_DIR, '', classifiers, hmm_cassettes, args.probability, hmm_missings, output_defaultdict)
+    if args.incremental and not prediction_memo:
+        # predictions are only remade for new cassettes or model files
+        Path(os.path.join(args.cassette_output_dir, STAMPS_DIR)).mkdir(parents=True, exist_ok=True)
+        prediction_memo = os.path.join(args.cassette_output_dir, STAMPS_DIR, 'prediction_memo.sqlite')
 
-        else:
-            for reg in args.regressors:
-                hmm_cassettes_reg = predict_missings(MODELS_DIR, reg, hmm_features, hmm_cassettes, hmm_missings)
+    registry = ModelRegistry(MODELS_DIR, model_memory, FLAT_MODELS_DIR if args.flat_trees else None, prediction_memo)
 
-                if args.run_mode == 'combined':
-                    print('Loading classifiers and running classification')
-                    classify(MODELS_DIR, reg, classifiers, hmm_cassettes_reg, args.probability, hmm_missings, output_defaultdict)
+    if args.preload_models or args.serve:
+        print('Loading models')
+        reg_names = [REGRESSORS[reg] for reg in args.regressors] if args.run_mode != 'classification' else []
+        clf_names = [CLASSIFIERS[clf] for clf in args.classifiers] if args.run_mode != 'regression' else []
+        registry.preload(args.hmm_sets, reg_names, clf_names)
+
+    hit_cache = HitCache(args.hit_cache, args.hit_cache_size) if args.hit_cache else None
+
+    if args.serve:
+        if args.hmm_database:
+            for hmm in args.hmm_sets:
+                build_hmm_database(os.path.join(HMM_DIR, hmm), os.path.join(HMM_DB_DIR, hmm), args.hmm_shards)
+
+        serve(lambda payload : predict_payload(payload, args, registry, hit_cache), args.serve, args.server_workers, args.server_queue)
+
+    else:
+        writer = PredictionWriter(args.output_file, args.output_format, args.output_chunk_size)
+
+        if args.batch:
+            samples = find_fasta_files(args.batch)
+            manifest = None
+
+            if args.batch_shard:
+                samples = shard_samples(samples, *args.batch_shard)
+                print('Shard {} of {}: {} genome(s)'.format(args.batch_shard[0], args.batch_shard[1], len(samples)))
+
+            if args.checkpoint_dir:
+                manifest_name = 'manifest_{}_of_{}'.format(*args.batch_shard) if args.batch_shard else 'manifest'
+                manifest = RunManifest(args.checkpoint_dir, checkpoint_options(args), manifest_name)
+                manifest.add(samples)
+
+            if samples:
+                run_batch(args, registry, samples, writer, hit_cache, manifest)
+
+            if manifest:
+                status_counts = manifest.status_counts(samples)
+                print('\n{} of {} genome(s) done, {} failed (see {})'.format(status_counts['done'], len(samples), status_counts['failed'], manifest.path))
+                manifest.close()
 
-        if output_defaultdict:
-            print('Saving class predictions to', args.output_file)
-            output_df = pd.DataFrame(output_defaultdict)
-            output_df.to_csv(args.output_file, index=False)
         else:
-            print('No predictions were made.')
\ No newline at end of file
+            arrays = build_cassette_arrays(args.fasta_file, args, registry, args.hmmsearch_output_dir, args.cassette_output_dir, hit_cache=hit_cache)
+            predict_cassettes(args, registry, *arrays, writer=writer)
+
+        if writer.close() == 0:
+            print('No predictions were made.')
+
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(args.cprofile)
+        print('cProfile dump saved to', args.cprofile)
+
+    if args.metrics:
+        metrics.save(args.metrics)
+        print('Metrics saved to', args.metrics)
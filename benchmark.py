@@ -0,0 +1,204 @@
+"""
+    CRISPRcasIdentifier
+    Copyright (C) 2020 Victor Alexandre Padilha <victorpadilha@usp.br>,
+                       Omer Salem Alkhnbashi <alkhanbo@informatik.uni-freiburg.de>,
+                       Shiraz Ali Shah <shiraz.shah@dbac.dk>,
+                       André Carlos Ponce de Leon Ferreira de Carvalho <andre@icmc.usp.br>,
+                       Rolf Backofen <backofen@informatik.uni-freiburg.de>
+
+    This file is part of CRISPRcasIdentifier.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os, time, json, platform, tempfile, tracemalloc
+import subprocess as sp
+import numpy as np
+import pandas as pd
+
+from argparse import ArgumentParser
+from collections import defaultdict
+from contextlib import redirect_stdout
+
+# Project imports
+from CRISPRcasIdentifier import (build_initial_dataframe, add_bitscores, build_cassettes, convert_cassette_dataframes_to_numpy_arrays,
+                                 predict_missings, classify, extract_targz, REGRESSORS, CLASSIFIERS, MODELS_DIR, FLAT_MODELS_DIR, MODELS_TAR_GZ)
+from cas import CORE
+from model_registry import ModelRegistry
+
+PROFILES_PER_GENE = 3
+
+def make_synthetic_genome(n_proteins, features, output_dir, seed=0, cassette_every=60, noise=0.02):
+    # Writes a prodigal-like protein fasta (headers only matter to the pipeline) and one canned tblout file per
+    # profile, with PROFILES_PER_GENE profiles per Cas gene of the HMM set. Cassettes of 3 to 8 genes (at least one
+    # of them a CORE gene) are planted about every cassette_every proteins, other proteins get a random hit with
+    # probability noise.
+    rng = np.random.RandomState(seed)
+    core = [f for f in features if f in CORE]
+    contig_sizes = rng.randint(50, 2000, size=n_proteins // 50 + 1)
+    contig_sizes = contig_sizes[np.cumsum(contig_sizes) - contig_sizes < n_proteins]
+    contig_sizes[-1] -= contig_sizes.sum() - n_proteins
+    tab_lines = defaultdict(list)
+    fasta_file = os.path.join(output_dir, 'synthetic_proteins.fa')
+
+    with open(fasta_file, 'w') as f:
+        for c, contig_size in enumerate(contig_sizes):
+            contig = 'contig{}'.format(c + 1)
+            genes = np.full(contig_size, None, dtype=object)
+
+            for start in range(rng.randint(cassette_every), contig_size, cassette_every):
+                cassette = rng.choice(features, size=min(rng.randint(3, 9), contig_size - start))
+                cassette[rng.randint(len(cassette))] = rng.choice(core)
+                genes[start:start + len(cassette)] = cassette
+
+            noisy = pd.isnull(genes) & (rng.rand(contig_size) < noise)
+            genes[noisy] = rng.choice(features, size=noisy.sum())
+            lengths = rng.randint(300, 1500, size=contig_size)
+            gaps = rng.randint(-20, 300, size=contig_size)
+            ends = np.cumsum(lengths + gaps)
+            starts = ends - lengths + 1
+
+            for k in range(contig_size):
+                description = '# {} # {} # {} # ID={}_{};partial=00;start_type=ATG'.format(starts[k], ends[k], rng.choice([-1, 1]), c + 1, k + 1)
+                f.write('>{}_{} {}\nM*\n'.format(contig, k + 1, description))
+
+                if genes[k] is not None:
+                    for p in rng.choice(PROFILES_PER_GENE, size=rng.randint(1, PROFILES_PER_GENE + 1), replace=False):
+                        bitscore = rng.uniform(1, 500)
+                        tab_lines['{}_{:04d}.tab'.format(genes[k], p)].append('{}_{} - {}_{:04d} - 1e-10 {:.1f} 0.0 1 1e-10 {:.1f} 0.0 1 1 1 1 1 1 1 {}\n'.format(
+                            contig, k + 1, genes[k], p, bitscore, bitscore, description))
+
+    hmm_output_dir = os.path.join(output_dir, 'hmmsearch')
+    os.mkdir(hmm_output_dir)
+
+    for feature in features:
+        for p in range(PROFILES_PER_GENE):
+            tab_file = '{}_{:04d}.tab'.format(feature, p)
+
+            with open(os.path.join(hmm_output_dir, tab_file), 'w') as f:
+                f.write('# synthetic tblout\n')
+                f.writelines(tab_lines[tab_file])
+
+    return fasta_file, hmm_output_dir
+
+def measure(stage, repeats, func):
+    # wall time of every repeat and peak of the memory allocated by Python and NumPy during the first one
+    seconds = []
+
+    for r in range(repeats):
+        if r == 0:
+            tracemalloc.start()
+
+        begin = time.perf_counter()
+
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            result = func()
+
+        seconds.append(time.perf_counter() - begin)
+
+        if r == 0:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    return result, {'stage' : stage, 'seconds' : seconds, 'min_seconds' : min(seconds), 'median_seconds' : float(np.median(seconds)), 'peak_memory_mb' : peak / 1024 ** 2}
+
+def benchmark(n_proteins, hmm, registry, regressors, classifiers, repeats, seed):
+    features = [str(f) for f in registry.features(hmm)]
+    results = []
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        fasta_file, hmm_output_dir = make_synthetic_genome(n_proteins, features, output_dir, seed)
+
+        protein_df, result = measure('build_initial_dataframe', repeats, lambda : build_initial_dataframe(fasta_file, 'dna'))
+        results.append(result)
+
+        annotated_protein_df, result = measure('add_bitscores', repeats, lambda : add_bitscores(hmm_output_dir, protein_df, 'dna'))
+        results.append(result)
+
+        cassette_dfs, result = measure('build_cassettes', repeats, lambda : build_cassettes({hmm : annotated_protein_df}, 'dna'))
+        result['n_cassettes'] = int(cassette_dfs[hmm]['cassette_id'].nunique())
+        results.append(result)
+
+        (hmm_features, hmm_cassettes, hmm_missings), result = measure('convert_cassette_dataframes_to_numpy_arrays', repeats,
+                                                                      lambda : convert_cassette_dataframes_to_numpy_arrays(cassette_dfs, registry, output_dir))
+        results.append(result)
+
+        for reg in regressors:
+            filled_cassettes, result = measure('predict_missings[{}]'.format(reg), repeats, lambda : predict_missings(registry, reg, hmm_features, hmm_cassettes, hmm_missings))
+            results.append(result)
+
+            _, result = measure('classify[{}]'.format(reg), repeats, lambda : classify(registry, reg, [CLASSIFIERS[clf] for clf in classifiers], filled_cassettes, False, hmm_missings, defaultdict(list)))
+            results.append(result)
+
+    for result in results:
+        result['n_proteins'] = n_proteins
+
+    return results
+
+def git_commit():
+    try:
+        return sp.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.realpath(__file__)), stderr=sp.DEVNULL, universal_newlines=True).strip()
+    except (OSError, sp.CalledProcessError):
+        return None
+
+def compare(results, baseline_file):
+    with open(baseline_file, 'r') as f:
+        baseline = {(r['n_proteins'], r['stage']) : r for r in json.load(f)['results']}
+
+    print('\n{:>10}  {:<48}{:>12}{:>12}{:>9}'.format('proteins', 'stage', 'baseline', 'current', 'ratio'))
+
+    for r in results:
+        b = baseline.get((r['n_proteins'], r['stage']))
+
+        if b:
+            print('{:>10}  {:<48}{:>11.4f}s{:>11.4f}s{:>8.2f}x'.format(r['n_proteins'], r['stage'], b['min_seconds'], r['min_seconds'], r['min_seconds'] / max(b['min_seconds'], 1e-9)))
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmarks each stage of the CRISPRcasIdentifier pipeline on synthetic genomes with planted cassettes (hmmsearch and prodigal are replaced by canned outputs).')
+    parser.add_argument('-n', '--sizes', nargs='+', dest='sizes', type=int, default=[1000, 10000, 100000], help='Number of proteins of each synthetic genome (default: 1000 10000 100000).', metavar='N')
+    parser.add_argument('-s', '--hmm-set', dest='hmm_set', default='HMM2019', help='HMM set whose features and models are used (default: HMM2019).', metavar='HMMi', choices=['HMM1', 'HMM2', 'HMM3', 'HMM4', 'HMM5', 'HMM2019'])
+    parser.add_argument('-r', '--regressors', nargs='+', dest='regressors', default=['ERT'], help='Regressors to benchmark (default: ERT).', metavar='reg', choices=list(REGRESSORS))
+    parser.add_argument('-c', '--classifiers', nargs='+', dest='classifiers', default=['ERT'], help='Classifiers to benchmark (default: ERT).', metavar='clf', choices=list(CLASSIFIERS))
+    parser.add_argument('-ft', '--flat-trees', dest='flat_trees', action='store_true', help='Whether to use the flattened tree models (see flat_trees.py).')
+    parser.add_argument('-R', '--repeats', dest='repeats', type=int, default=3, help='Number of timed runs of each stage (default: 3).', metavar='N')
+    parser.add_argument('--seed', dest='seed', type=int, default=0, help='Seed of the synthetic genomes (default: 0).', metavar='N')
+    parser.add_argument('-o', '--output-file', dest='output_file', default='./benchmark.json', help='Where to store the results as JSON (default: ./benchmark.json).')
+    parser.add_argument('--compare', dest='compare', help='JSON results of a previous run (e.g. of another commit) to compare with.', metavar='/path/to/benchmark.json')
+    args = parser.parse_args()
+
+    if not os.path.exists(MODELS_DIR):
+        extract_targz(MODELS_TAR_GZ)
+
+    # models are loaded before any stage is timed
+    registry = ModelRegistry(MODELS_DIR, flat_models_dir=FLAT_MODELS_DIR if args.flat_trees else None)
+    registry.preload([args.hmm_set], [REGRESSORS[reg] for reg in args.regressors], [CLASSIFIERS[clf] for clf in args.classifiers])
+    results = []
+
+    for n_proteins in args.sizes:
+        print('Benchmarking {} proteins'.format(n_proteins))
+
+        for result in benchmark(n_proteins, args.hmm_set, registry, args.regressors, args.classifiers, args.repeats, args.seed):
+            print('  {:<48}{:>10.4f}s{:>10.1f} MB'.format(result['stage'], result['min_seconds'], result['peak_memory_mb']))
+            results.append(result)
+
+    output = {'commit' : git_commit(), 'python' : platform.python_version(), 'numpy' : np.__version__, 'pandas' : pd.__version__, 'platform' : platform.platform(),
+              'hmm_set' : args.hmm_set, 'flat_trees' : args.flat_trees, 'repeats' : args.repeats, 'seed' : args.seed, 'results' : results}
+
+    with open(args.output_file, 'w') as f:
+        json.dump(output, f, indent=2)
+
+    print('Results saved to', args.output_file)
+
+    if args.compare:
+        compare(results, args.compare)
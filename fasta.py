@@ -0,0 +1,237 @@
+"""
+    CRISPRcasIdentifier
+    Copyright (C) 2020 Victor Alexandre Padilha <victorpadilha@usp.br>,
+                       Omer Salem Alkhnbashi <alkhanbo@informatik.uni-freiburg.de>,
+                       Shiraz Ali Shah <shiraz.shah@dbac.dk>,
+                       André Carlos Ponce de Leon Ferreira de Carvalho <andre@icmc.usp.br>,
+                       Rolf Backofen <backofen@informatik.uni-freiburg.de>
+
+    This file is part of CRISPRcasIdentifier.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os, io, gzip, zlib, struct, bisect
+
+from functools import lru_cache
+
+BLOCK_SIZE = 1 << 20
+GZIP_MAGIC = b'\x1f\x8b'
+# fasta files compressed with gzip or bgzip (hmmsearch only recognizes the .gz suffix)
+COMPRESSED_EXTENSIONS = ('.gz',)
+
+def is_gzip(fasta_file):
+    with open(fasta_file, 'rb') as f:
+        return f.read(2) == GZIP_MAGIC
+
+def open_fasta(fasta_file, mode='r'):
+    # plain, gzip or bgzip (which is multi-member gzip) fasta files, in text ('r') or binary ('rb') mode
+    if not is_gzip(fasta_file):
+        return open(fasta_file, mode)
+
+    f = io.BufferedReader(gzip.open(fasta_file, 'rb'), BLOCK_SIZE)
+    return f if mode == 'rb' else io.TextIOWrapper(f)
+
+def strip_compressed_extension(fasta_file):
+    for ext in COMPRESSED_EXTENSIONS:
+        if fasta_file.lower().endswith(ext):
+            return fasta_file[:-len(ext)]
+
+    return fasta_file
+
+def fasta_blocks(fasta_file):
+    # the uncompressed content of fasta_file, in blocks
+    with open_fasta(fasta_file, 'rb') as f:
+        for block in iter(lambda : f.read(BLOCK_SIZE), b''):
+            yield block
+
+def scan_headers(fasta_file):
+    # (offset, header line) of every record, offsets in uncompressed bytes, and the uncompressed size of the file.
+    # The content is searched block by block for line starts with '>', sequence lines are never split or decoded.
+    headers = []
+
+    with open_fasta(fasta_file, 'rb') as f:
+        # a virtual newline before the first byte, so that a header on the first line is found like the others
+        data = b'\n' + f.read(BLOCK_SIZE)
+        base, i = -1, 0
+
+        while True:
+            j = data.find(b'\n>', i)
+
+            if j < 0:
+                block = f.read(BLOCK_SIZE)
+
+                if not block:
+                    break
+
+                # the last byte is kept, as a newline and the '>' after it may be in different blocks
+                base += len(data) - 1
+                data, i = data[-1:] + block, 0
+                continue
+
+            end = data.find(b'\n', j + 1)
+
+            while end < 0:
+                block = f.read(BLOCK_SIZE)
+
+                if not block:
+                    end = len(data)
+                    break
+
+                data += block
+                end = data.find(b'\n', j + 1)
+
+            headers.append((base + j + 1, data[j + 1:end].decode().rstrip('\r')))
+            i = end
+
+    return headers, base + len(data)
+
+class FastaIndex:
+    # faidx-style index of a fasta file (plain, gzip or bgzip): offset and size in uncompressed bytes and header line of
+    # every record. It is only kept in memory (see fasta_index), nothing is written next to the input files.
+    # Records are read back with a seek in plain and bgzip files, gzip files have to be read from the start.
+
+    def __init__(self, fasta_file):
+        self.fasta_file = fasta_file
+        headers, total_size = scan_headers(fasta_file)
+        self.offsets = [offset for offset, _ in headers]
+        self.sizes = [end - offset for offset, end in zip(self.offsets, self.offsets[1:] + [total_size])]
+        self.headers = [header for _, header in headers]
+        # block list of a bgzip file, made on the first read
+        self.bgzf = None
+
+    def read(self, first, count):
+        # the records first to first + count - 1 (uncompressed, in blocks)
+        return self.fetch(range(first, first + count))
+
+    def fetch(self, records):
+        # the given records (positions in the file), in file order; consecutive records are read together
+        records = sorted(set(records))
+        ranges = []
+
+        for i in records:
+            if ranges and ranges[-1][1] == self.offsets[i]:
+                ranges[-1][1] += self.sizes[i]
+            else:
+                ranges.append([self.offsets[i], self.offsets[i] + self.sizes[i]])
+
+        return self.read_ranges(ranges)
+
+    def read_ranges(self, ranges):
+        if self.bgzf is None:
+            self.bgzf = BgzfReader(self.fasta_file) if is_bgzf(self.fasta_file) else False
+
+        if self.bgzf:
+            for start, end in ranges:
+                yield from self.bgzf.read(start, end)
+            return
+
+        with open_fasta(self.fasta_file, 'rb') as f:
+            # there is no random access in plain gzip files, which are read once from the start, skipping what is
+            # between the ranges
+            seekable = not is_gzip(self.fasta_file)
+            position = 0
+
+            for start, end in ranges:
+                if seekable:
+                    f.seek(start)
+                else:
+                    while position < start:
+                        block = f.read(min(start - position, BLOCK_SIZE))
+
+                        if not block:
+                            return
+
+                        position += len(block)
+
+                position = start
+
+                while position < end:
+                    block = f.read(min(end - position, BLOCK_SIZE))
+
+                    if not block:
+                        return
+
+                    position += len(block)
+                    yield block
+
+def fasta_index(fasta_file):
+    # the index of the current version of fasta_file, made once per run (e.g. for the protein table and the two-stage
+    # search of the same proteins)
+    stat = os.stat(fasta_file)
+    return cached_fasta_index(os.path.realpath(fasta_file), stat.st_size, stat.st_mtime_ns)
+
+@lru_cache(maxsize=4)
+def cached_fasta_index(path, size, mtime_ns):
+    return FastaIndex(path)
+
+def is_bgzf(fasta_file):
+    # bgzip files are gzip files whose members carry their compressed size in a 'BC' extra subfield
+    with open(fasta_file, 'rb') as f:
+        return bgzf_block_size(f.read(18 + 256)) is not None
+
+def bgzf_block_size(header):
+    if len(header) < 18 or header[:2] != GZIP_MAGIC or not header[3] & 4:
+        return None
+
+    xlen = struct.unpack('<H', header[10:12])[0]
+    extra = header[12:12 + xlen]
+    i = 0
+
+    while i + 4 <= len(extra):
+        slen = struct.unpack('<H', extra[i + 2:i + 4])[0]
+
+        if extra[i:i + 2] == b'BC' and slen == 2:
+            return struct.unpack('<H', extra[i + 4:i + 6])[0] + 1
+
+        i += 4 + slen
+
+    return None
+
+class BgzfReader:
+    # Random access to the uncompressed content of a bgzip file. Its blocks (at most 64 KB uncompressed each) are
+    # listed from their headers and trailers only, as in a .gzi index, and only the blocks of a range are decompressed.
+
+    def __init__(self, path):
+        self.path = path
+        self.coffsets, self.uoffsets = [], []
+        coffset, uoffset = 0, 0
+
+        with open(path, 'rb') as f:
+            while True:
+                f.seek(coffset)
+                block_size = bgzf_block_size(f.read(18 + 256))
+
+                if block_size is None:
+                    break
+
+                f.seek(coffset + block_size - 4)
+                isize = struct.unpack('<I', f.read(4))[0]
+                self.coffsets.append(coffset)
+                self.uoffsets.append(uoffset)
+                coffset += block_size
+                uoffset += isize
+
+        self.coffsets.append(coffset)
+        self.uoffsets.append(uoffset)
+
+    def read(self, start, end):
+        b = bisect.bisect_right(self.uoffsets, start) - 1
+
+        with open(self.path, 'rb') as f:
+            while b < len(self.coffsets) - 1 and self.uoffsets[b] < end:
+                f.seek(self.coffsets[b])
+                data = zlib.decompress(f.read(self.coffsets[b + 1] - self.coffsets[b]), 31)
+                yield data[max(0, start - self.uoffsets[b]):end - self.uoffsets[b]]
+                b += 1
@@ -0,0 +1,192 @@
+"""
+    CRISPRcasIdentifier
+    Copyright (C) 2020 Victor Alexandre Padilha <victorpadilha@usp.br>,
+                       Omer Salem Alkhnbashi <alkhanbo@informatik.uni-freiburg.de>,
+                       Shiraz Ali Shah <shiraz.shah@dbac.dk>,
+                       André Carlos Ponce de Leon Ferreira de Carvalho <andre@icmc.usp.br>,
+                       Rolf Backofen <backofen@informatik.uni-freiburg.de>
+
+    This file is part of CRISPRcasIdentifier.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os, json
+import numpy as np
+import joblib
+
+from argparse import ArgumentParser
+
+NODE_DTYPE = np.dtype([('feature', '<i4'), ('threshold', '<f8'), ('left', '<i4'), ('right', '<i4')])
+
+class FlatTreeEnsemble:
+    # Decision trees and extra trees (regressors or classifiers) flattened into one array of nodes and one array of
+    # node values, with the nodes of every tree one after the other. Predictions are computed for all the trees and
+    # samples at once, one tree level per step, and match sklearn's (inputs are compared as float32, and the trees
+    # are summed up in order before the average, as sklearn does).
+
+    def __init__(self, nodes, values, roots, classes=None, n_features=None):
+        self.nodes = nodes
+        self.values = values
+        self.roots = np.asarray(roots, dtype=np.int64)
+        self.classes_ = np.asarray(classes) if classes is not None else None
+        self.n_features_in_ = n_features
+
+    def leaves(self, X):
+        # leaf reached by every sample in every tree, as a (trees, samples) array; only the (tree, sample)
+        # pairs still at an inner node are moved down at each step
+        X = np.asarray(X, dtype=np.float32)
+        n_samples, n_features = X.shape
+        X = X.ravel()
+        feature = self.nodes['feature']
+        threshold = self.nodes['threshold']
+        left = self.nodes['left']
+        right = self.nodes['right']
+        leaves = np.repeat(self.roots, n_samples)
+        pairs = np.flatnonzero(left[leaves] >= 0)
+        current = leaves[pairs]
+        offsets = (pairs % n_samples) * n_features
+
+        while pairs.size:
+            go_left = X[offsets + feature[current]] <= threshold[current]
+            current = np.where(go_left, left[current], right[current])
+            inner = left[current] >= 0
+            leaves[pairs[~inner]] = current[~inner]
+            pairs, current, offsets = pairs[inner], current[inner], offsets[inner]
+
+        return leaves.reshape(len(self.roots), n_samples)
+
+    def predict(self, X):
+        if self.classes_ is not None:
+            return self.classes_.take(np.argmax(self.predict_proba(X), axis=1))
+
+        y = np.zeros(np.shape(X)[0])
+
+        for tree_leaves in self.leaves(X):
+            y += self.values[tree_leaves, 0]
+
+        return y / len(self.roots)
+
+    def predict_proba(self, X):
+        proba = np.zeros((np.shape(X)[0], self.values.shape[1]))
+
+        for tree_leaves in self.leaves(X):
+            tree_proba = self.values[tree_leaves]
+            normalizer = tree_proba.sum(axis=1)[:, np.newaxis]
+            normalizer[normalizer == 0.0] = 1.0
+            proba += tree_proba / normalizer
+
+        return proba / len(self.roots)
+
+def is_tree_model(model):
+    return hasattr(model, 'tree_') or (hasattr(model, 'estimators_') and all(hasattr(tree, 'tree_') for tree in np.ravel(model.estimators_)))
+
+def flatten_model(model):
+    trees = [model] if hasattr(model, 'tree_') else list(np.ravel(model.estimators_))
+
+    if model.n_outputs_ != 1:
+        raise ValueError('Only single output trees can be flattened')
+
+    nodes, values, roots = [], [], []
+    offset = 0
+
+    for tree in trees:
+        tree_ = tree.tree_
+        tree_nodes = np.empty(tree_.node_count, dtype=NODE_DTYPE)
+        tree_nodes['feature'] = tree_.feature
+        tree_nodes['threshold'] = tree_.threshold
+        tree_nodes['left'] = np.where(tree_.children_left >= 0, tree_.children_left + offset, -1)
+        tree_nodes['right'] = np.where(tree_.children_right >= 0, tree_.children_right + offset, -1)
+        nodes.append(tree_nodes)
+        values.append(tree_.value[:, 0, :])
+        roots.append(offset)
+        offset += tree_.node_count
+
+    classes = model.classes_ if hasattr(model, 'classes_') else None
+
+    if classes is not None:
+        values = [v[:, :len(classes)] for v in values]
+
+    return FlatTreeEnsemble(np.concatenate(nodes), np.ascontiguousarray(np.concatenate(values), dtype=np.float64), roots, classes, getattr(model, 'n_features_in_', None))
+
+def save_flat_model(flat_model, flat_model_prefix, source_file=None):
+    # every file is written under a temporary name and then renamed, so that processes converting the same model at
+    # the same time never see half written files; the metadata goes last, as a conversion is complete once it exists
+    meta = {'roots' : flat_model.roots.tolist(), 'classes' : flat_model.classes_.tolist() if flat_model.classes_ is not None else None,
+            'n_features' : flat_model.n_features_in_, 'source' : source_signature(source_file) if source_file else None}
+    tmp_suffix = '.tmp{}'.format(os.getpid())
+
+    for extension, array in (('.nodes.npy', flat_model.nodes), ('.values.npy', flat_model.values)):
+        with open(flat_model_prefix + extension + tmp_suffix, 'wb') as f:
+            np.save(f, array)
+
+        os.replace(flat_model_prefix + extension + tmp_suffix, flat_model_prefix + extension)
+
+    with open(flat_model_prefix + '.json' + tmp_suffix, 'w') as f:
+        json.dump(meta, f)
+
+    os.replace(flat_model_prefix + '.json' + tmp_suffix, flat_model_prefix + '.json')
+
+def load_flat_model(flat_model_prefix, source_file=None):
+    # the node arrays are memory-mapped, so processes loading the same model share its pages;
+    # None if there is no flat model, or if it was made from another version of source_file
+    if not os.path.exists(flat_model_prefix + '.json'):
+        return None
+
+    with open(flat_model_prefix + '.json', 'r') as f:
+        meta = json.load(f)
+
+    if source_file and meta['source'] != source_signature(source_file):
+        return None
+
+    nodes = np.load(flat_model_prefix + '.nodes.npy', mmap_mode='r')
+    values = np.load(flat_model_prefix + '.values.npy', mmap_mode='r')
+    return FlatTreeEnsemble(nodes, values, meta['roots'], meta['classes'], meta['n_features'])
+
+def source_signature(source_file):
+    # nanosecond modification time, so that a model rewritten within the same second with the same size is seen
+    stat = os.stat(source_file)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def convert_models(models_dir, flat_models_dir):
+    if not os.path.exists(flat_models_dir):
+        os.mkdir(flat_models_dir)
+
+    n_converted = 0
+
+    for model_file in sorted(os.listdir(models_dir)):
+        if not model_file.endswith('.joblib'):
+            continue
+
+        source_file = os.path.join(models_dir, model_file)
+        flat_model_prefix = os.path.join(flat_models_dir, model_file[:-len('.joblib')])
+
+        if load_flat_model(flat_model_prefix, source_file) is not None:
+            continue
+
+        model = joblib.load(source_file)
+
+        if is_tree_model(model):
+            save_flat_model(flatten_model(model), flat_model_prefix, source_file)
+            n_converted += 1
+
+    return n_converted
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Flattens the tree models (CART and ERT) of the trained models directory into memory-mappable NumPy arrays.')
+    parser.add_argument('-m', '--models-dir', dest='models_dir', default=os.path.join(os.path.dirname(os.path.realpath(__file__)), 'trained_models'), help='Trained models directory (default: trained_models).')
+    parser.add_argument('-o', '--output-dir', dest='output_dir', default=os.path.join(os.path.dirname(os.path.realpath(__file__)), 'trained_models_flat'), help='Where to store the flattened models (default: trained_models_flat).')
+    args = parser.parse_args()
+
+    print('{} model(s) flattened into {}'.format(convert_models(args.models_dir, args.output_dir), args.output_dir))
@@ -0,0 +1,98 @@
+"""
+    CRISPRcasIdentifier
+    Copyright (C) 2020 Victor Alexandre Padilha <victorpadilha@usp.br>,
+                       Omer Salem Alkhnbashi <alkhanbo@informatik.uni-freiburg.de>,
+                       Shiraz Ali Shah <shiraz.shah@dbac.dk>,
+                       André Carlos Ponce de Leon Ferreira de Carvalho <andre@icmc.usp.br>,
+                       Rolf Backofen <backofen@informatik.uni-freiburg.de>
+
+    This file is part of CRISPRcasIdentifier.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import sqlite3, threading, time
+import pandas as pd
+
+class HitCache:
+    # On-disk (SQLite) store of the hmmsearch hits of each protein sequence, keyed by the hash of the sequence
+    # and by a key identifying the HMM set version and search parameters. A sequence that was searched and had
+    # no hits is remembered as well, so only sequences never seen before have to be searched again.
+    # If max_entries is set, the least recently used (sequence, HMM set) entries are evicted beyond it.
+
+    def __init__(self, path, max_entries=None):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS searched (seq_hash TEXT, hmm_key TEXT, last_used REAL, PRIMARY KEY (seq_hash, hmm_key))')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS searched_last_used ON searched (last_used)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS hits (seq_hash TEXT, hmm_key TEXT, annotation TEXT, bitscore REAL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS hits_seq_hash ON hits (seq_hash, hmm_key)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS stats (hmm_key TEXT PRIMARY KEY, hits INTEGER, misses INTEGER)')
+
+    def lookup(self, hmm_key, seq_hashes):
+        # returns the cached hits of seq_hashes as a (seq_hash, annotation, bitscore) table and the hashes found in the cache
+        seq_hashes = list(seq_hashes)
+        found = []
+        hits = []
+
+        with self.lock, self.connection:
+            for i in range(0, len(seq_hashes), 500):
+                chunk = seq_hashes[i:i + 500]
+                placeholders = ','.join('?' * len(chunk))
+                found.extend(row[0] for row in self.connection.execute('SELECT seq_hash FROM searched WHERE hmm_key = ? AND seq_hash IN ({})'.format(placeholders), [hmm_key] + chunk))
+                hits.extend(self.connection.execute('SELECT seq_hash, annotation, bitscore FROM hits WHERE hmm_key = ? AND seq_hash IN ({})'.format(placeholders), [hmm_key] + chunk))
+
+            now = time.time()
+            self.connection.executemany('UPDATE searched SET last_used = ? WHERE seq_hash = ? AND hmm_key = ?', ((now, h, hmm_key) for h in found))
+            self.update_stats(hmm_key, len(found), len(seq_hashes) - len(found))
+
+        hits = pd.DataFrame(hits, columns=['seq_hash', 'annotation', 'bitscore']).astype({'bitscore' : float})
+        return hits, set(found)
+
+    def store(self, hmm_key, seq_hashes, hits):
+        # seq_hashes: every sequence that was searched; hits: their (seq_hash, annotation, bitscore) table
+        now = time.time()
+
+        with self.lock, self.connection:
+            self.connection.executemany('DELETE FROM hits WHERE seq_hash = ? AND hmm_key = ?', ((h, hmm_key) for h in seq_hashes))
+            self.connection.executemany('INSERT OR REPLACE INTO searched VALUES (?, ?, ?)', ((h, hmm_key, now) for h in seq_hashes))
+            self.connection.executemany('INSERT INTO hits VALUES (?, ?, ?, ?)', ((h, hmm_key, a, float(b)) for h, a, b in hits[['seq_hash', 'annotation', 'bitscore']].itertuples(index=False)))
+
+            if self.max_entries is not None:
+                self.evict()
+
+    def evict(self):
+        n_entries = self.connection.execute('SELECT COUNT(*) FROM searched').fetchone()[0]
+
+        if n_entries > self.max_entries:
+            self.connection.execute('CREATE TEMP TABLE evicted AS SELECT seq_hash, hmm_key FROM searched ORDER BY last_used LIMIT ?', (n_entries - self.max_entries,))
+            self.connection.execute('DELETE FROM hits WHERE (seq_hash, hmm_key) IN (SELECT seq_hash, hmm_key FROM evicted)')
+            self.connection.execute('DELETE FROM searched WHERE (seq_hash, hmm_key) IN (SELECT seq_hash, hmm_key FROM evicted)')
+            self.connection.execute('DROP TABLE evicted')
+
+    def update_stats(self, hmm_key, hits, misses):
+        self.connection.execute('INSERT OR IGNORE INTO stats VALUES (?, 0, 0)', (hmm_key,))
+        self.connection.execute('UPDATE stats SET hits = hits + ?, misses = misses + ? WHERE hmm_key = ?', (hits, misses, hmm_key))
+
+    def stats(self, hmm_key):
+        with self.lock:
+            row = self.connection.execute('SELECT hits, misses FROM stats WHERE hmm_key = ?', (hmm_key,)).fetchone()
+
+        return row if row else (0, 0)
+
+    def close(self):
+        self.connection.close()
@@ -23,29 +23,272 @@
 """
 
 import subprocess as sp
-import os
+import os, time, hashlib, tarfile, io, threading, shutil, tempfile
 
-def hmmsearch(hmmsearch_cmd, fasta_file, hmm_dir, hmm_sets, hmmsearch_output_dir, cutoff=1000):
-    if not os.path.exists(hmmsearch_output_dir):
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+
+# Project imports
+from metrics import metrics
+
+DATABASE_FINGERPRINT = 'fingerprint'
+DATABASE_PROFILES = 'profiles.tsv'
+HMMSEARCH_ARCHIVE = 'hmmsearch_outputs.tar.gz'
+
+def hmmsearch(hmmsearch_cmd, fasta_file, hmm_dir, hmm_sets, hmmsearch_output_dir, cutoff=1000, database_dir=None, shards=1, threads=None, profiles=None, profile_set=None, raw_output='files', keep_archived=False, n_targets=None):
+    # profiles optionally restricts each HMM set to some of its .hmm files (profiles[hmm]), in which case
+    # profile_set names that selection so that its profile database is cached apart from the full set's.
+    # The tblout of every job is read from its stdout pipe and returned as {hmm: {tab file name: lines}}. The raw
+    # outputs (.tab and .log files) are also written to hmmsearch_output_dir ('files'), packed into one archive in
+    # it ('archive') or not kept at all ('none'). With keep_archived, the archived outputs of other HMM sets are kept.
+    # Either way they are written as the jobs finish: the log of a job right after it, the .tab files of an HMM set
+    # after its last job.
+    # n_targets sets the number of target sequences E-values are computed for (-Z and --domZ), so that a search over
+    # some of the proteins keeps the E-values (and so the hits under the cutoff) of a search over all of them.
+    if raw_output != 'none' and not os.path.exists(hmmsearch_output_dir):
         os.mkdir(hmmsearch_output_dir)
 
-    hmm_set_output_directories = []
+    if raw_output == 'archive':
+        raw_output_dir = raw_output_archive(hmmsearch_output_dir, hmm_sets, keep_archived)
+    else:
+        raw_output_dir = nullcontext((None, hmmsearch_output_dir))
+
+    with raw_output_dir as (tar, log_dir):
+        jobs = []
+        job_outputs = []
+
+        for hmm in hmm_sets:
+            hmm_set_dir = os.path.join(hmm_dir, hmm)
+            hmm_set_output_dir = os.path.join(log_dir, hmm)
+
+            if raw_output != 'none' and not os.path.exists(hmm_set_output_dir):
+                os.mkdir(hmm_set_output_dir)
+
+            hmm_files = profiles[hmm] if profiles is not None else os.listdir(hmm_set_dir)
+
+            if database_dir:
+                hmm_database_dir = os.path.join(database_dir, hmm if profile_set is None else hmm + '_' + profile_set)
+                shard_files, profile_names = build_hmm_database(hmm_set_dir, hmm_database_dir, shards, hmm_files)
+
+                for i, shard_file in enumerate(shard_files):
+                    jobs.append(hmmsearch_job(hmmsearch_cmd, shard_file, fasta_file, cutoff, os.path.join(hmm_set_output_dir, 'shard{}.log'.format(i)), raw_output, n_targets))
+                    job_outputs.append((hmm, profile_names, 'shard{}.log'.format(i)))
+
+                continue
+
+            for hmm_f in hmm_files:
+                hmm_file_path = os.path.join(hmm_set_dir, hmm_f)
+                jobs.append(hmmsearch_job(hmmsearch_cmd, hmm_file_path, fasta_file, cutoff, os.path.join(hmm_set_output_dir, hmm_f.replace('.hmm', '.log')), raw_output, n_targets))
+                job_outputs.append((hmm, hmm_f, hmm_f.replace('.hmm', '.log')))
+
+        hmm_hits = {hmm : {} for hmm in hmm_sets}
+        # the jobs of an HMM set are consecutive, its .tab files are complete after the last one
+        last_jobs = {hmm : i for i, (hmm, _, _) in enumerate(job_outputs)}
+
+        for i, (result, seconds) in enumerate(run_jobs(jobs, threads)):
+            (hmm, source, log_name), (_, log_file_path) = job_outputs[i], jobs[i]
+            lines = result.stdout.splitlines(True)
+            # wall time of the job, under its HMM set and under its profile (or database shard)
+            metrics.add_stage('hmmsearch/' + hmm, seconds)
+            metrics.add_stage('hmmsearch/{}/{}'.format(hmm, log_name.rsplit('.', 1)[0]), seconds)
+
+            if isinstance(source, dict):
+                for tab_file, tab_lines in split_database_hits(lines, source).items():
+                    hmm_hits[hmm].setdefault(tab_file, []).extend(tab_lines)
+            else:
+                hmm_hits[hmm][source.replace('.hmm', '.tab')] = lines
+
+            if raw_output == 'none':
+                continue
+
+            with open(log_file_path, 'a') as log_file:
+                log_file.write(result.stderr)
+
+            if tar:
+                with open(log_file_path, 'rb') as log_file:
+                    add_archive_member(tar, hmm + '/' + log_name, log_file, os.path.getsize(log_file_path))
+
+                os.remove(log_file_path)
+
+            if last_jobs[hmm] != i:
+                continue
+
+            for tab_file, tab_lines in hmm_hits[hmm].items():
+                if tar:
+                    data = ''.join(tab_lines).encode()
+                    add_archive_member(tar, hmm + '/' + tab_file, io.BytesIO(data), len(data))
+                else:
+                    with open(os.path.join(hmmsearch_output_dir, hmm, tab_file), 'w') as f:
+                        f.writelines(tab_lines)
+
+    return hmm_hits
+
+@contextmanager
+def raw_output_archive(hmmsearch_output_dir, hmm_sets, keep_archived):
+    # The archive of the raw outputs, as (tar file, folder for the logs). hmmsearch writes the log of each job to the
+    # folder, from which it is moved into the archive once the job is done, so that no log is held in memory. The
+    # archive replaces the previous one only once all jobs succeeded.
+    archive_file = os.path.join(hmmsearch_output_dir, HMMSEARCH_ARCHIVE)
+    tmp_file = archive_file + '.tmp{}-{}'.format(os.getpid(), threading.get_ident())
+    log_dir = tempfile.mkdtemp(dir=hmmsearch_output_dir)
+
+    try:
+        with tarfile.open(tmp_file, 'w:gz') as tar:
+            if keep_archived and os.path.exists(archive_file):
+                # the outputs of other HMM sets are copied member by member from the previous archive
+                with tarfile.open(archive_file, 'r:gz') as previous:
+                    for member in previous:
+                        if member.isfile() and member.name.split('/')[0] not in hmm_sets:
+                            tar.addfile(member, previous.extractfile(member))
+
+            yield tar, log_dir
+
+        os.replace(tmp_file, archive_file)
+    finally:
+        shutil.rmtree(log_dir, ignore_errors=True)
+
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+def add_archive_member(tar, name, fileobj, size):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    tar.addfile(info, fileobj)
+
+def hmmsearch_job(hmmsearch_cmd, hmm_file_path, fasta_file, cutoff, log_file_path, raw_output, n_targets=None):
+    # the tblout is always written to stdout; the main output goes to the log file (to be archived with 'archive')
+    # or nowhere
+    main_output = os.devnull if raw_output == 'none' else log_file_path
+    search_space = ['-Z', str(n_targets), '--domZ', str(n_targets)] if n_targets else []
+    return [hmmsearch_cmd, '--tblout', '/dev/stdout', '-o', main_output, '-E', str(cutoff)] + search_space + [hmm_file_path, fasta_file], log_file_path
+
+def schedule(n_jobs, threads):
+    # Splits a core budget between concurrent hmmsearch processes and the --cpu threads of each of them:
+    # many small jobs run side by side with one thread each, few large jobs (e.g. database shards) get more threads.
+    workers = max(1, min(n_jobs, threads))
+    cpu = max(1, threads // workers)
+    return workers, cpu
+
+def run_jobs(jobs, threads=None):
+    if threads:
+        workers, cpu = schedule(len(jobs), threads)
+    else:
+        workers, cpu = 1, None
+
+    def run(job):
+        cmd, _ = job
+
+        if cpu:
+            cmd = cmd[:1] + ['--cpu', str(cpu)] + cmd[1:]
+
+        begin = time.perf_counter()
+        result = sp.run(cmd, stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+        return result, time.perf_counter() - begin
+
+    # the results are yielded in the order of the jobs as they come in, and a failed job raises after the last one
+    failed = []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for (_, log_file_path), (result, seconds) in zip(jobs, executor.map(run, jobs)):
+            if result.returncode != 0:
+                failed.append((log_file_path, result))
+
+            yield result, seconds
+
+    if failed:
+        for log_file_path, result in failed:
+            print('hmmsearch failed with exit code {} ({}): {}'.format(result.returncode, os.path.basename(log_file_path), result.stderr.strip()[-500:]))
+
+        raise RuntimeError('{} of {} hmmsearch job(s) failed'.format(len(failed), len(jobs)))
+
+def hmm_set_fingerprint(hmm_set_dir, hmm_files=None):
+    md5 = hashlib.md5()
+
+    for hmm_f in sorted(hmm_files if hmm_files is not None else os.listdir(hmm_set_dir)):
+        md5.update(hmm_f.encode())
+
+        with open(os.path.join(hmm_set_dir, hmm_f), 'rb') as f:
+            md5.update(f.read())
+
+    return md5.hexdigest()
+
+def build_hmm_database(hmm_set_dir, hmm_database_dir, shards=1, hmm_files=None):
+    # Concatenates every profile of an HMM set into one multi-profile file (or a few shards of similar size).
+    # Profile names are rewritten so that hits can be traced back to the .hmm file they came from. Every file is
+    # written under a temporary name and then renamed, the fingerprint last, so that runs or server requests using
+    # the same database at the same time never read a half written shard or a fingerprint of other shards.
+    hmm_files = sorted(hmm_files if hmm_files is not None else os.listdir(hmm_set_dir))
+    shards = max(1, min(shards, len(hmm_files)))
+    fingerprint = '{}-{}'.format(hmm_set_fingerprint(hmm_set_dir, hmm_files), shards)
+    fingerprint_file = os.path.join(hmm_database_dir, DATABASE_FINGERPRINT)
+    profiles_file = os.path.join(hmm_database_dir, DATABASE_PROFILES)
+    shard_files = [os.path.join(hmm_database_dir, 'shard{}.hmm'.format(i)) for i in range(shards)]
+
+    if os.path.exists(fingerprint_file) and all(os.path.exists(f) for f in shard_files):
+        with open(fingerprint_file, 'r') as f:
+            if f.read().strip() == fingerprint:
+                with open(profiles_file, 'r') as pf:
+                    profile_names = dict(line.rstrip('\n').split('\t') for line in pf)
+                return shard_files, profile_names
+
+    print('Building profile database for', hmm_set_dir)
+    os.makedirs(hmm_database_dir, exist_ok=True)
+    tmp_suffix = '.tmp{}-{}'.format(os.getpid(), threading.get_ident())
+
+    # the shards are not valid anymore from here on
+    try:
+        os.remove(fingerprint_file)
+    except FileNotFoundError:
+        pass
+
+    sizes = [os.path.getsize(os.path.join(hmm_set_dir, hmm_f)) for hmm_f in hmm_files]
+    shard_sizes = [0] * shards
+    shard_profiles = [[] for _ in range(shards)]
+
+    # largest profiles first, each one going to the currently smallest shard
+    for i in sorted(range(len(hmm_files)), key=lambda i : -sizes[i]):
+        s = shard_sizes.index(min(shard_sizes))
+        shard_profiles[s].append(i)
+        shard_sizes[s] += sizes[i]
+
+    profile_names = {}
+
+    for shard_file, profiles in zip(shard_files, shard_profiles):
+        with open(shard_file + tmp_suffix, 'w') as out:
+            for i in sorted(profiles):
+                k = 0
+
+                with open(os.path.join(hmm_set_dir, hmm_files[i]), 'r') as f:
+                    for line in f:
+                        if line.startswith('NAME '):
+                            name = '{}_{}'.format(i, k)
+                            profile_names[name] = hmm_files[i]
+                            line = 'NAME  {}\n'.format(name)
+                            k += 1
+
+                        out.write(line)
+
+        os.replace(shard_file + tmp_suffix, shard_file)
+
+    with open(profiles_file + tmp_suffix, 'w') as f:
+        for name, hmm_f in profile_names.items():
+            f.write('{}\t{}\n'.format(name, hmm_f))
+
+    os.replace(profiles_file + tmp_suffix, profiles_file)
 
-    for hmm in hmm_sets:
-        hmm_set_dir = os.path.join(hmm_dir, hmm)
-        hmm_set_output_dir = os.path.join(hmmsearch_output_dir, hmm)
-        hmm_set_output_directories.append(hmm_set_output_dir)
+    with open(fingerprint_file + tmp_suffix, 'w') as f:
+        f.write(fingerprint + '\n')
 
-        if not os.path.exists(hmm_set_output_dir):
-            os.mkdir(hmm_set_output_dir)
+    os.replace(fingerprint_file + tmp_suffix, fingerprint_file)
 
-        hmm_files = os.listdir(hmm_set_dir)
+    return shard_files, profile_names
 
-        for hmm_f in hmm_files:
-            hmm_file_path = os.path.join(hmm_set_dir, hmm_f)
+def split_database_hits(lines, profile_names):
+    # one list of tblout lines per profile, exactly as if each profile had been searched on its own
+    profile_hits = {hmm_f.replace('.hmm', '.tab') : [] for hmm_f in profile_names.values()}
 
-            output_file_path = os.path.join(hmm_set_output_dir, hmm_f.replace('.hmm', '.tab'))
-            log_file_path = os.path.join(hmm_set_output_dir, hmm_f.replace('.hmm', '.log'))
+    for line in lines:
+        if not line.startswith('#'):
+            profile_hits[profile_names[line.split(None, 3)[2]].replace('.hmm', '.tab')].append(line)
 
-            with open(log_file_path, 'w') as log_file:
-                sp.call([hmmsearch_cmd, '--tblout', output_file_path, '-E', str(cutoff), hmm_file_path, fasta_file], stdout=log_file, stderr=log_file)
\ No newline at end of file
+    return profile_hits
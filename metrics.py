@@ -0,0 +1,107 @@
+"""
+    CRISPRcasIdentifier
+    Copyright (C) 2020 Victor Alexandre Padilha <victorpadilha@usp.br>,
+                       Omer Salem Alkhnbashi <alkhanbo@informatik.uni-freiburg.de>,
+                       Shiraz Ali Shah <shiraz.shah@dbac.dk>,
+                       André Carlos Ponce de Leon Ferreira de Carvalho <andre@icmc.usp.br>,
+                       Rolf Backofen <backofen@informatik.uni-freiburg.de>
+
+    This file is part of CRISPRcasIdentifier.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import sys, time, json, resource, threading
+
+from contextlib import contextmanager
+
+def cpu_time():
+    # CPU time of this process and of its subprocesses that have already finished (prodigal, hmmsearch, workers)
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return resource.getrusage(who).ru_maxrss / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+class Metrics:
+    # Wall time, CPU time and peak RSS (so far) of each pipeline stage, plus counters. Stages that run several
+    # times (e.g. once per genome of a batch) are summed up. CPU time is process wide, so stages running at the
+    # same time in different threads share it. Worker processes hand what they recorded to the main process (see
+    # take and merge), so their stages are summed up with the others.
+
+    def __init__(self):
+        self.stages = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        wall, cpu = time.perf_counter(), cpu_time()
+
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - wall, cpu_time() - cpu)
+
+    def add_stage(self, name, wall_seconds, cpu_seconds=None):
+        with self.lock:
+            stage = self.stages.setdefault(name, {'calls' : 0, 'wall_seconds' : 0.0})
+            stage['calls'] += 1
+            stage['wall_seconds'] += wall_seconds
+
+            if cpu_seconds is not None:
+                stage['cpu_seconds'] = stage.get('cpu_seconds', 0.0) + cpu_seconds
+                stage['peak_rss_mb'] = peak_rss_mb()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + int(n)
+
+    def take(self):
+        # stages and counts recorded since the last call, which are cleared
+        with self.lock:
+            recorded = {'stages' : self.stages, 'counts' : self.counts}
+            self.stages, self.counts = {}, {}
+
+        return recorded
+
+    def merge(self, recorded):
+        # adds up what take() returned in another process
+        with self.lock:
+            for name, other in recorded['stages'].items():
+                stage = self.stages.setdefault(name, {'calls' : 0, 'wall_seconds' : 0.0})
+                stage['calls'] += other['calls']
+                stage['wall_seconds'] += other['wall_seconds']
+
+                if 'cpu_seconds' in other:
+                    stage['cpu_seconds'] = stage.get('cpu_seconds', 0.0) + other['cpu_seconds']
+                    stage['peak_rss_mb'] = max(stage.get('peak_rss_mb', 0.0), other['peak_rss_mb'])
+
+            for name, n in recorded['counts'].items():
+                self.counts[name] = self.counts.get(name, 0) + n
+
+    def report(self):
+        with self.lock:
+            return {'wall_seconds' : time.perf_counter() - self.start, 'cpu_seconds' : cpu_time(), 'peak_rss_mb' : peak_rss_mb(),
+                    'children_peak_rss_mb' : peak_rss_mb(resource.RUSAGE_CHILDREN), 'stages' : dict(self.stages), 'counts' : dict(self.counts)}
+
+    def save(self, metrics_file):
+        with open(metrics_file, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+# shared by all modules of a run
+metrics = Metrics()
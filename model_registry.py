@@ -0,0 +1,135 @@
+"""
+    CRISPRcasIdentifier
+    Copyright (C) 2020 Victor Alexandre Padilha <victorpadilha@usp.br>,
+                       Omer Salem Alkhnbashi <alkhanbo@informatik.uni-freiburg.de>,
+                       Shiraz Ali Shah <shiraz.shah@dbac.dk>,
+                       André Carlos Ponce de Leon Ferreira de Carvalho <andre@icmc.usp.br>,
+                       Rolf Backofen <backofen@informatik.uni-freiburg.de>
+
+    This file is part of CRISPRcasIdentifier.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os, threading
+import joblib
+
+from collections import OrderedDict
+
+# Project imports
+from metrics import metrics
+from flat_trees import load_flat_model, save_flat_model, flatten_model, is_tree_model
+from prediction_memo import PredictionMemo, predict_unique
+
+class ModelRegistry:
+    # Keeps every joblib file from the models directory in memory after its first use.
+    # If max_bytes is set, the least recently used models are dropped once the total size
+    # (approximated by the size of the files on disk) goes beyond it.
+    # If flat_models_dir is set, tree models are used in their flattened form (see flat_trees.py), which is made
+    # there the first time each of them is loaded.
+    # If memo_path is set, the outputs of predict() are also kept in a PredictionMemo (SQLite file) there.
+
+    def __init__(self, models_dir, max_bytes=None, flat_models_dir=None, memo_path=None):
+        self.models_dir = models_dir
+        self.max_bytes = max_bytes
+        self.flat_models_dir = flat_models_dir
+        self.memo_path = memo_path
+        self.memo = PredictionMemo(memo_path) if memo_path else None
+        self.models = OrderedDict()
+        self.total_bytes = 0
+        self.n_loads = 0
+        self.lock = threading.Lock()
+
+    def load(self, name):
+        with self.lock:
+            return self._load(name)
+
+    def _load(self, name):
+        if name in self.models:
+            self.models.move_to_end(name)
+            return self.models[name][0]
+
+        model_file_path = os.path.join(self.models_dir, name + '.joblib')
+
+        if self.flat_models_dir:
+            model = self._load_flat(name, model_file_path)
+        else:
+            model = joblib.load(model_file_path)
+
+        size = os.path.getsize(model_file_path)
+        self.n_loads += 1
+        metrics.count('model_loads')
+
+        self.models[name] = (model, size)
+        self.total_bytes += size
+
+        if self.max_bytes is not None:
+            while self.total_bytes > self.max_bytes and len(self.models) > 1:
+                _, (_, evicted_size) = self.models.popitem(last=False)
+                self.total_bytes -= evicted_size
+
+        return model
+
+    def _load_flat(self, name, model_file_path):
+        flat_model_prefix = os.path.join(self.flat_models_dir, name)
+        model = load_flat_model(flat_model_prefix, model_file_path)
+
+        if model is None:
+            model = joblib.load(model_file_path)
+
+            if is_tree_model(model):
+                os.makedirs(self.flat_models_dir, exist_ok=True)
+                save_flat_model(flatten_model(model), flat_model_prefix, model_file_path)
+                model = load_flat_model(flat_model_prefix)
+
+        return model
+
+    def version(self, name):
+        # nanosecond modification time, so that a model replaced within the same second with the same size is seen
+        stat = os.stat(os.path.join(self.models_dir, name + '.joblib'))
+        return '{}-{}'.format(stat.st_size, stat.st_mtime_ns)
+
+    def predict(self, name, X, method='predict'):
+        # output of the model's predict (or predict_proba) method, computed once per distinct row of X
+        model = self.load(name)
+        model_key = '{}-{}-{}'.format(name, self.version(name), method) if self.memo else None
+        return predict_unique(getattr(model, method), X, self.memo, model_key)
+
+    def features(self, hmm):
+        return self.load(hmm + '_features')
+
+    def scaler(self, hmm):
+        return self.load(hmm + '_scaler')
+
+    def encoder(self, hmm):
+        return self.load(hmm + '_encoder')
+
+    def regressor(self, hmm, reg_name, feature):
+        return self.load(hmm + '_' + reg_name + '_' + feature)
+
+    def classifier(self, hmm, clf_name):
+        return self.load(hmm + '_' + clf_name)
+
+    def preload(self, hmm_sets, reg_names=(), clf_names=()):
+        for hmm in hmm_sets:
+            features = self.features(hmm)
+            self.scaler(hmm)
+            self.encoder(hmm)
+
+            for reg_name in reg_names:
+                for f in features:
+                    self.regressor(hmm, reg_name, f)
+
+            for clf_name in clf_names:
+                self.classifier(hmm, clf_name)
@@ -0,0 +1,105 @@
+"""
+    CRISPRcasIdentifier
+    Copyright (C) 2020 Victor Alexandre Padilha <victorpadilha@usp.br>,
+                       Omer Salem Alkhnbashi <alkhanbo@informatik.uni-freiburg.de>,
+                       Shiraz Ali Shah <shiraz.shah@dbac.dk>,
+                       André Carlos Ponce de Leon Ferreira de Carvalho <andre@icmc.usp.br>,
+                       Rolf Backofen <backofen@informatik.uni-freiburg.de>
+
+    This file is part of CRISPRcasIdentifier.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import sys, io, asyncio, threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+# marks the end of the items in a queue
+END = object()
+
+class ThreadOutput:
+    # Stands in for sys.stdout while a pipeline runs: what a stage prints for an item is kept apart and printed in one
+    # piece once the stage is done with it, so that the messages of the items in flight do not get mixed up.
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        buffer = getattr(self.local, 'buffer', None)
+        return (buffer if buffer is not None else self.stdout).write(text)
+
+    def flush(self):
+        if getattr(self.local, 'buffer', None) is None:
+            self.stdout.flush()
+
+    def run(self, stage, item):
+        self.local.buffer = io.StringIO()
+
+        try:
+            return stage(item)
+        finally:
+            with self.lock:
+                self.stdout.write(self.local.buffer.getvalue())
+                self.stdout.flush()
+
+            self.local.buffer = None
+
+def run_pipeline(items, stages, depth=1):
+    # Passes every item through stages, a list of functions each taking what the previous one returns. Every stage
+    # runs in its own thread and takes the items in order, one at a time, so that while a stage works on an item the
+    # previous stages already work on the next ones (e.g. prodigal and hmmsearch on the next genome while the cassettes
+    # of the current one are predicted). At most depth items wait between two stages.
+    output = ThreadOutput(sys.stdout)
+    sys.stdout = output
+
+    try:
+        asyncio.run(run_stages(items, stages, depth, output))
+    finally:
+        sys.stdout = output.stdout
+
+async def run_stages(items, stages, depth, output):
+    loop = asyncio.get_event_loop()
+    queues = [asyncio.Queue(maxsize=depth) for _ in stages]
+
+    async def feed():
+        for item in items:
+            await queues[0].put(item)
+
+        await queues[0].put(END)
+
+    async def run_stage(i, stage, executor):
+        while True:
+            item = await queues[i].get()
+
+            if item is END:
+                break
+
+            result = await loop.run_in_executor(executor, output.run, stage, item)
+
+            if i + 1 < len(stages):
+                await queues[i + 1].put(result)
+
+        if i + 1 < len(stages):
+            await queues[i + 1].put(END)
+
+    executors = [ThreadPoolExecutor(max_workers=1) for _ in stages]
+
+    try:
+        await asyncio.gather(feed(), *(run_stage(i, stage, executor) for i, (stage, executor) in enumerate(zip(stages, executors))))
+    finally:
+        for executor in executors:
+            executor.shutdown(wait=True)
@@ -0,0 +1,87 @@
+"""
+    CRISPRcasIdentifier
+    Copyright (C) 2020 Victor Alexandre Padilha <victorpadilha@usp.br>,
+                       Omer Salem Alkhnbashi <alkhanbo@informatik.uni-freiburg.de>,
+                       Shiraz Ali Shah <shiraz.shah@dbac.dk>,
+                       André Carlos Ponce de Leon Ferreira de Carvalho <andre@icmc.usp.br>,
+                       Rolf Backofen <backofen@informatik.uni-freiburg.de>
+
+    This file is part of CRISPRcasIdentifier.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import sqlite3, threading, hashlib, json
+import numpy as np
+
+# Project imports
+from metrics import metrics
+
+class PredictionMemo:
+    # On-disk (SQLite) store of model outputs, keyed by a key identifying the model file version and method and by
+    # the hash of the input row, so that rows seen in previous runs are not predicted again. Outputs are kept as
+    # JSON, which gives back the very same floats.
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        # several worker processes may share the file
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS predictions (model_key TEXT, row_hash TEXT, prediction TEXT, PRIMARY KEY (model_key, row_hash))')
+
+    def lookup(self, model_key, row_hashes):
+        found = {}
+
+        with self.lock:
+            for i in range(0, len(row_hashes), 500):
+                chunk = row_hashes[i:i + 500]
+                placeholders = ','.join('?' * len(chunk))
+                found.update(self.connection.execute('SELECT row_hash, prediction FROM predictions WHERE model_key = ? AND row_hash IN ({})'.format(placeholders), [model_key] + chunk))
+
+        return {row_hash : np.asarray(json.loads(prediction)) for row_hash, prediction in found.items()}
+
+    def store(self, model_key, predictions):
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?)', ((model_key, row_hash, json.dumps(np.asarray(p).tolist())) for row_hash, p in predictions.items()))
+
+    def close(self):
+        self.connection.close()
+
+def predict_unique(predict, X, memo=None, model_key=None):
+    # Runs predict (a model's predict or predict_proba) once for each distinct row of X and copies the output
+    # to the repeated rows. With a memo, the outputs of rows predicted before by the same model are reused.
+    if X.shape[0] == 0:
+        # models refuse empty inputs (e.g. no cassette of an HMM set has a known protein)
+        return np.empty(0)
+
+    unique_X, inverse = np.unique(X, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    metrics.count('predicted_rows', X.shape[0])
+    metrics.count('unique_rows', unique_X.shape[0])
+
+    if memo is None:
+        return predict(unique_X)[inverse]
+
+    row_hashes = [hashlib.md5(row.tobytes()).hexdigest() for row in np.ascontiguousarray(unique_X, dtype=np.float64)]
+    memoised = memo.lookup(model_key, row_hashes)
+    missing = [i for i, row_hash in enumerate(row_hashes) if row_hash not in memoised]
+    metrics.count('memo_hits', len(row_hashes) - len(missing))
+
+    if missing:
+        predictions = predict(unique_X[missing])
+        memoised.update(zip((row_hashes[i] for i in missing), predictions))
+        memo.store(model_key, {row_hashes[i] : p for i, p in zip(missing, predictions)})
+
+    return np.asarray([memoised[row_hash] for row_hash in row_hashes])[inverse]
@@ -0,0 +1,207 @@
+"""
+    CRISPRcasIdentifier
+    Copyright (C) 2020 Victor Alexandre Padilha <victorpadilha@usp.br>,
+                       Omer Salem Alkhnbashi <alkhanbo@informatik.uni-freiburg.de>,
+                       Shiraz Ali Shah <shiraz.shah@dbac.dk>,
+                       André Carlos Ponce de Leon Ferreira de Carvalho <andre@icmc.usp.br>,
+                       Rolf Backofen <backofen@informatik.uni-freiburg.de>
+
+    This file is part of CRISPRcasIdentifier.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os, json, shutil, sqlite3
+import numpy as np
+import pandas as pd
+
+from pathlib import Path
+
+OUTPUT_FORMATS = {'.csv' : 'csv', '.jsonl' : 'jsonl', '.json' : 'jsonl', '.parquet' : 'parquet', '.sqlite' : 'sqlite', '.db' : 'sqlite'}
+
+def to_json(obj):
+    # json.dumps default for the numpy scalars of prediction rows (also used by the server responses)
+    if isinstance(obj, np.generic):
+        return obj.item()
+
+    raise TypeError('{} is not JSON serializable'.format(type(obj).__name__))
+
+def output_format(output_file, format_=None):
+    if format_:
+        return format_
+
+    return OUTPUT_FORMATS.get(os.path.splitext(output_file)[1].lower(), 'csv')
+
+class PredictionWriter:
+    # Appends the prediction rows (an output_defaultdict of columns) to the output file as they are made. Rows are
+    # buffered and written in chunks of at most chunk_size rows, and whatever is buffered is written by flush(), so
+    # that the file can be read while the run is going on. The file is only created with the first rows.
+
+    def __init__(self, output_file, format_=None, chunk_size=1000):
+        self.output_file = output_file
+        self.format = output_format(output_file, format_)
+        self.chunk_size = chunk_size
+        self.buffer = []
+        self.n_rows = 0
+        self.out = None
+
+        if self.format == 'parquet':
+            try:
+                import pyarrow, pyarrow.parquet
+            except ImportError:
+                raise ImportError('Parquet output requires pyarrow (pip install pyarrow)')
+
+            self.pyarrow = pyarrow
+
+    def write(self, output_defaultdict):
+        # takes the rows out of output_defaultdict, which is left empty
+        columns = list(output_defaultdict)
+
+        if columns:
+            self.buffer.extend(dict(zip(columns, values)) for values in zip(*(output_defaultdict[c] for c in columns)))
+            output_defaultdict.clear()
+
+        while len(self.buffer) >= self.chunk_size:
+            self.write_chunk(self.buffer[:self.chunk_size])
+            self.buffer = self.buffer[self.chunk_size:]
+
+    def flush(self):
+        if self.buffer:
+            self.write_chunk(self.buffer)
+            self.buffer = []
+
+    def write_chunk(self, rows):
+        chunk_df = pd.DataFrame(rows)
+
+        if self.out is None:
+            self.open()
+
+        if self.format == 'csv':
+            chunk_df.to_csv(self.out, header=self.n_rows == 0, index=False)
+            self.out.flush()
+
+        elif self.format == 'jsonl':
+            for row in rows:
+                self.out.write(json.dumps(row, default=to_json) + '\n')
+
+            self.out.flush()
+
+        else:
+            # lists of (label, probability) pairs are stored as JSON text
+            chunk_df = chunk_df.apply(lambda column : column.map(lambda value : json.dumps(value, default=to_json) if isinstance(value, list) else value))
+
+            if self.format == 'sqlite':
+                chunk_df.to_sql('predictions', self.out, if_exists='append', index=False)
+                self.out.commit()
+            else:
+                table = self.pyarrow.Table.from_pandas(chunk_df, preserve_index=False)
+
+                if self.n_rows == 0:
+                    self.out = self.pyarrow.parquet.ParquetWriter(self.output_file, table.schema)
+
+                self.out.write_table(table.cast(self.out.schema))
+
+        self.n_rows += len(rows)
+
+    def open(self):
+        output_dir = os.path.dirname(self.output_file)
+
+        if output_dir and not os.path.exists(output_dir):
+            Path(output_dir).mkdir(parents=True, exist_ok=True)
+
+        print('Saving class predictions to', self.output_file)
+
+        if self.format in ('csv', 'jsonl'):
+            self.out = open(self.output_file, 'w')
+
+        elif self.format == 'sqlite':
+            self.out = sqlite3.connect(self.output_file)
+            self.out.execute('DROP TABLE IF EXISTS predictions')
+
+        else:
+            # the parquet writer needs the schema of the first chunk, see write_chunk
+            self.out = False
+
+    def close(self):
+        self.flush()
+
+        if self.out:
+            self.out.close()
+
+        return self.n_rows
+
+def merge_prediction_files(input_files, output_file, format_=None):
+    # joins prediction files of the same format and columns (e.g. of the shards of a batch) into output_file, in
+    # the given order; input files that do not exist are skipped, as no file is made when there are no predictions
+    format_ = output_format(output_file, format_)
+    input_files = [f for f in input_files if os.path.exists(f)]
+
+    for input_file in input_files:
+        if output_format(input_file) != format_:
+            raise ValueError('{} is not a {} file'.format(input_file, format_))
+
+    output_dir = os.path.dirname(output_file)
+
+    if output_dir and not os.path.exists(output_dir):
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
+
+    if format_ in ('csv', 'jsonl'):
+        header = None
+
+        with open(output_file, 'w') as out:
+            for input_file in input_files:
+                with open(input_file, 'r') as f:
+                    if format_ == 'csv':
+                        file_header = f.readline()
+
+                        if header is None:
+                            header = file_header
+                            out.write(header)
+                        elif file_header != header:
+                            raise ValueError('{} has other columns than {}'.format(input_file, input_files[0]))
+
+                    shutil.copyfileobj(f, out)
+
+    elif format_ == 'sqlite':
+        out = sqlite3.connect(output_file)
+        out.execute('DROP TABLE IF EXISTS predictions')
+
+        for i, input_file in enumerate(input_files):
+            out.execute('ATTACH DATABASE ? AS shard', (input_file,))
+            out.execute(('CREATE TABLE predictions AS' if i == 0 else 'INSERT INTO predictions') + ' SELECT * FROM shard.predictions')
+            out.commit()
+            out.execute('DETACH DATABASE shard')
+
+        out.close()
+
+    else:
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError('Parquet output requires pyarrow (pip install pyarrow)')
+
+        out = None
+
+        for input_file in input_files:
+            table = pyarrow.parquet.read_table(input_file)
+
+            if out is None:
+                out = pyarrow.parquet.ParquetWriter(output_file, table.schema)
+
+            out.write_table(table.cast(out.schema))
+
+        if out:
+            out.close()
+
+    return len(input_files)
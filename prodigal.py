@@ -23,17 +23,128 @@
 """
 
 import subprocess as sp
-import os
+import os, re
 
-def prodigal(prodigal_cmd, fasta_file, completeness):
+from concurrent.futures import ThreadPoolExecutor
+
+# Project imports
+from fasta import fasta_index, is_gzip, fasta_blocks, strip_compressed_extension
+
+def prodigal(prodigal_cmd, fasta_file, completeness, output_dir=None, threads=None):
     meta = ' -p meta ' if completeness == 'partial' else ''
-    fasta_file_preffix = fasta_file.rsplit('.', 1)[0]
+    fasta_file_preffix = strip_compressed_extension(fasta_file).rsplit('.', 1)[0]
+
+    if output_dir:
+        fasta_file_preffix = os.path.join(output_dir, os.path.basename(fasta_file_preffix))
     output_fasta_file = fasta_file_preffix + '_proteins.fa'
     log_file = fasta_file_preffix + '_prodigal.log'
-    prodigal_cmd += ' -i {input_fasta}  -c -m -g 11 -a {output_fasta} -q' + meta
-    prodigal_cmd = prodigal_cmd.format(prodigal=prodigal_cmd, input_fasta=fasta_file, output_fasta=output_fasta_file)
+
+    if threads and threads > 1:
+        index = fasta_index(fasta_file)
+        chunks = split_contigs(index.sizes, threads)
+
+        if len(chunks) > 1:
+            prodigal_chunks(prodigal_cmd, fasta_file, index, chunks, meta, fasta_file_preffix, output_fasta_file, log_file)
+            return output_fasta_file
+
+    prodigal_cmd += ' -c -m -g 11 -a {output_fasta} -q' + meta
+    prodigal_cmd = prodigal_cmd.format(prodigal=prodigal_cmd, output_fasta=output_fasta_file)
     
     with open(log_file, 'w') as lf:
-        sp.call(prodigal_cmd.split(), stdout=lf)
+        if run_prodigal(prodigal_cmd.split(), fasta_file, lf) != 0:
+            raise RuntimeError('prodigal failed on {} (see {})'.format(fasta_file, log_file))
     
     return output_fasta_file
+
+def run_prodigal(cmd, fasta_file, lf, blocks=None):
+    # Plain fasta files are given to prodigal with -i. Compressed ones, and parts of a file (blocks), are written to
+    # its standard input as they are decompressed or read, so that no uncompressed copy is ever written to disk.
+    if blocks is None and not is_gzip(fasta_file):
+        return sp.call(cmd + ['-i', fasta_file], stdout=lf)
+
+    process = sp.Popen(cmd, stdin=sp.PIPE, stdout=lf)
+
+    try:
+        for block in (blocks if blocks is not None else fasta_blocks(fasta_file)):
+            process.stdin.write(block)
+
+        process.stdin.close()
+    except BrokenPipeError:
+        # prodigal stopped reading, its return code tells why
+        pass
+
+    return process.wait()
+
+def split_contigs(lengths, n_chunks):
+    # contiguous runs of contigs of about the same total length, as (first contig, number of contigs) pairs
+    total = sum(lengths)
+    chunks = []
+    first, size = 0, 0
+
+    for i, length in enumerate(lengths):
+        size += length
+
+        if size * n_chunks >= total * (len(chunks) + 1) or i == len(lengths) - 1:
+            chunks.append((first, i + 1 - first))
+            first = i + 1
+
+    return chunks
+
+def prodigal_chunks(prodigal_cmd, fasta_file, index, chunks, meta, fasta_file_preffix, output_fasta_file, log_file):
+    # Gene calling is independent for each contig in meta mode. In single mode, prodigal is trained once on the
+    # whole input, so that every chunk is predicted with the same model as in a run over the whole file. Each job
+    # reads its contigs from the input through the index (see run_prodigal).
+    jobs = []
+    options = ' -c -m -q' + meta
+
+    with open(log_file, 'w') as lf:
+        if not meta:
+            training_file = fasta_file_preffix + '_prodigal.trn'
+
+            if os.path.exists(training_file):
+                os.remove(training_file)
+
+            if run_prodigal((prodigal_cmd + ' -c -m -g 11 -t {} -q'.format(training_file)).split(), fasta_file, lf) != 0:
+                raise RuntimeError('prodigal training failed (see {})'.format(log_file))
+
+            options += ' -t ' + training_file
+        else:
+            options += ' -g 11'
+
+    for chunk_index, chunk in enumerate(chunks):
+        chunk_preffix = fasta_file_preffix + '_chunk{}'.format(chunk_index)
+        jobs.append(((prodigal_cmd + ' -a {}'.format(chunk_preffix + '_proteins.fa') + options).split(), chunk, chunk_preffix))
+
+    def run(job):
+        cmd, (first, count), chunk_preffix = job
+
+        with open(chunk_preffix + '_prodigal.log', 'w') as lf:
+            return run_prodigal(cmd, fasta_file, lf, index.read(first, count))
+
+    with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+        return_codes = list(executor.map(run, jobs))
+
+    failed = [chunk_preffix + '_prodigal.log' for (_, _, chunk_preffix), code in zip(jobs, return_codes) if code != 0]
+
+    if failed:
+        raise RuntimeError('{} of {} prodigal job(s) failed (see {})'.format(len(failed), len(jobs), ', '.join(failed)))
+
+    # prodigal numbers the sequences of its input from 1 in the ID field, which is shifted back to the
+    # position of each contig in the whole input
+    with open(output_fasta_file, 'w') as out, open(log_file, 'a') as lf:
+        for _, (first, _), chunk_preffix in jobs:
+            with open(chunk_preffix + '_proteins.fa', 'r') as f:
+                for line in f:
+                    if line.startswith('>'):
+                        line = re.sub(r'# ID=(\d+)_', lambda m : '# ID={}_'.format(int(m.group(1)) + first), line, count=1)
+
+                    out.write(line)
+
+            with open(chunk_preffix + '_prodigal.log', 'r') as f:
+                lf.write(f.read())
+
+            for path in (chunk_preffix + '_proteins.fa', chunk_preffix + '_prodigal.log'):
+                os.remove(path)
+
+    if not meta:
+        os.remove(training_file)
@@ -0,0 +1,157 @@
+"""
+    CRISPRcasIdentifier
+    Copyright (C) 2020 Victor Alexandre Padilha <victorpadilha@usp.br>,
+                       Omer Salem Alkhnbashi <alkhanbo@informatik.uni-freiburg.de>,
+                       Shiraz Ali Shah <shiraz.shah@dbac.dk>,
+                       André Carlos Ponce de Leon Ferreira de Carvalho <andre@icmc.usp.br>,
+                       Rolf Backofen <backofen@informatik.uni-freiburg.de>
+
+    This file is part of CRISPRcasIdentifier.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os, json, pickle, shutil, sqlite3, threading, time
+
+from argparse import ArgumentTypeError
+from collections import Counter
+
+# stages of a genome, in order; the result of each of them is checkpointed once it is finished
+STAGES = ('prodigal', 'hmmsearch', 'annotation', 'prediction')
+
+class RunManifest:
+    # On-disk (SQLite) record of the last finished stage of every genome of a batch run, with the results of the
+    # finished stages (checkpoints) stored in one directory per genome, so that an interrupted run resumes each
+    # genome where it stopped. Genomes whose fasta file changed start over, and a manifest is only reused with the
+    # options it was made with. The stages of different genomes may run in different threads (see pipeline.py).
+
+    def __init__(self, checkpoint_dir, options, name='manifest'):
+        self.checkpoint_dir = checkpoint_dir
+        self.lock = threading.Lock()
+
+        if not os.path.exists(checkpoint_dir):
+            os.makedirs(checkpoint_dir, exist_ok=True)
+
+        self.path = os.path.join(checkpoint_dir, name + '.sqlite')
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS run (key TEXT PRIMARY KEY, value TEXT)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS genomes (sample TEXT PRIMARY KEY, fasta TEXT, signature TEXT, stage TEXT, status TEXT, error TEXT, updated REAL)')
+            row = self.connection.execute("SELECT value FROM run WHERE key = 'options'").fetchone()
+
+            if row is None:
+                self.connection.execute("INSERT INTO run VALUES ('options', ?)", (json.dumps(options, sort_keys=True),))
+            elif json.loads(row[0]) != options:
+                raise ValueError('{} was made with other options ({}), use another checkpoint directory'.format(self.path, row[0]))
+
+    def add(self, samples):
+        # registers the (sample, fasta file) pairs of the run
+        with self.lock, self.connection:
+            known = {sample : signature for sample, signature in self.connection.execute('SELECT sample, signature FROM genomes')}
+
+            for sample, fasta_file in samples:
+                signature = fasta_signature(fasta_file)
+
+                if sample not in known or known[sample] != signature:
+                    shutil.rmtree(self.genome_dir(sample), ignore_errors=True)
+                    self.connection.execute('INSERT OR REPLACE INTO genomes VALUES (?, ?, ?, ?, ?, ?, ?)', (sample, fasta_file, signature, '', 'pending', None, time.time()))
+
+    def stage(self, sample):
+        # last finished stage of sample ('' if none)
+        with self.lock:
+            return self.connection.execute('SELECT stage FROM genomes WHERE sample = ?', (sample,)).fetchone()[0]
+
+    def done(self, sample, stage):
+        finished = self.stage(sample)
+        return bool(finished) and STAGES.index(stage) <= STAGES.index(finished)
+
+    def finish(self, sample, stage, result):
+        # the checkpoint is written before the stage is recorded as finished
+        genome_dir = self.genome_dir(sample)
+
+        if not os.path.exists(genome_dir):
+            os.makedirs(genome_dir, exist_ok=True)
+
+        checkpoint_file = os.path.join(genome_dir, stage + '.pkl')
+
+        with open(checkpoint_file + '.tmp', 'wb') as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.replace(checkpoint_file + '.tmp', checkpoint_file)
+        status = 'done' if stage == STAGES[-1] else 'pending'
+
+        with self.lock, self.connection:
+            self.connection.execute('UPDATE genomes SET stage = ?, status = ?, error = NULL, updated = ? WHERE sample = ?', (stage, status, time.time(), sample))
+
+    def load(self, sample, stage):
+        with open(os.path.join(self.genome_dir(sample), stage + '.pkl'), 'rb') as f:
+            return pickle.load(f)
+
+    def fail(self, sample, error):
+        # the finished stages are kept, the genome is retried from there on the next run
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE genomes SET status = 'failed', error = ?, updated = ? WHERE sample = ?", ('{}: {}'.format(type(error).__name__, error), time.time(), sample))
+
+    def status_counts(self, samples):
+        with self.lock:
+            return Counter(self.connection.execute('SELECT status FROM genomes WHERE sample = ?', (sample,)).fetchone()[0] for sample, _ in samples)
+
+    def genome(self, sample):
+        return GenomeCheckpoint(self, sample)
+
+    def genome_dir(self, sample):
+        return os.path.join(self.checkpoint_dir, sample)
+
+    def close(self):
+        self.connection.close()
+
+class GenomeCheckpoint:
+    # the checkpoints of one genome of a RunManifest
+
+    def __init__(self, manifest, sample):
+        self.manifest = manifest
+        self.sample = sample
+
+    def done(self, stage):
+        return self.manifest.done(self.sample, stage)
+
+    def load(self, stage):
+        return self.manifest.load(self.sample, stage)
+
+    def save(self, stage, result):
+        self.manifest.finish(self.sample, stage, result)
+
+def fasta_signature(fasta_file):
+    # nanosecond modification time, so that a file rewritten within the same second with the same size is seen
+    stat = os.stat(fasta_file)
+    return '{}-{}'.format(stat.st_size, stat.st_mtime_ns)
+
+def shard_spec(value):
+    # argparse type of K/N (the K-th of N shards, from 1)
+    try:
+        k, n = (int(x) for x in value.split('/'))
+    except ValueError:
+        raise ArgumentTypeError('expected K/N, got {}'.format(value))
+
+    if not 1 <= k <= n:
+        raise ArgumentTypeError('K must be between 1 and N, got {}'.format(value))
+
+    return k, n
+
+def shard_samples(samples, k, n):
+    # K-th of n contiguous parts of samples, of (almost) the same size, so that the predictions of the shards
+    # joined in order are in the order of the whole batch
+    bounds = [len(samples) * i // n for i in range(n + 1)]
+    return samples[bounds[k - 1]:bounds[k]]
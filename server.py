@@ -0,0 +1,119 @@
+"""
+    CRISPRcasIdentifier
+    Copyright (C) 2020 Victor Alexandre Padilha <victorpadilha@usp.br>,
+                       Omer Salem Alkhnbashi <alkhanbo@informatik.uni-freiburg.de>,
+                       Shiraz Ali Shah <shiraz.shah@dbac.dk>,
+                       André Carlos Ponce de Leon Ferreira de Carvalho <andre@icmc.usp.br>,
+                       Rolf Backofen <backofen@informatik.uni-freiburg.de>
+
+    This file is part of CRISPRcasIdentifier.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os, json, socket, socketserver, threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Project imports
+from prediction_writer import to_json
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+    def server_close(self):
+        ThreadingHTTPServer.server_close(self)
+
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+def serve(predict, address, workers=1, max_queue=16):
+    # Answers POST /predict with the records returned by predict(payload) for the JSON payload of the request.
+    # At most `workers` requests are processed at the same time and at most `max_queue` others wait for a slot.
+    slots = threading.BoundedSemaphore(workers)
+    pending = [0]
+    lock = threading.Lock()
+
+    class PredictionHandler(BaseHTTPRequestHandler):
+
+        def address_string(self):
+            return self.client_address[0] if self.client_address else 'unix'
+
+        def send_json(self, code, content):
+            body = json.dumps(content, default=to_json).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/health':
+                self.send_json(200, {'status' : 'ok', 'pending' : pending[0]})
+            else:
+                self.send_json(404, {'error' : 'unknown path {}'.format(self.path)})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self.send_json(404, {'error' : 'unknown path {}'.format(self.path)})
+                return
+
+            try:
+                payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            except ValueError as e:
+                self.send_json(400, {'error' : 'invalid JSON payload: {}'.format(e)})
+                return
+
+            with lock:
+                if pending[0] >= workers + max_queue:
+                    self.send_json(503, {'error' : 'too many pending requests'})
+                    return
+
+                pending[0] += 1
+
+            try:
+                with slots:
+                    records = predict(payload)
+
+                self.send_json(200, {'predictions' : records})
+            except (ValueError, KeyError, FileNotFoundError) as e:
+                self.send_json(400, {'error' : str(e)})
+            except Exception as e:
+                self.send_json(500, {'error' : '{}: {}'.format(type(e).__name__, e)})
+            finally:
+                with lock:
+                    pending[0] -= 1
+
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+        server = ThreadingHTTPServer((host, int(port)), PredictionHandler)
+    else:
+        server = UnixHTTPServer(address, PredictionHandler)
+
+    print('Serving predictions on', address)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,84 @@
+"""
+    CRISPRcasIdentifier
+    Copyright (C) 2020 Victor Alexandre Padilha <victorpadilha@usp.br>,
+                       Omer Salem Alkhnbashi <alkhanbo@informatik.uni-freiburg.de>,
+                       Shiraz Ali Shah <shiraz.shah@dbac.dk>,
+                       André Carlos Ponce de Leon Ferreira de Carvalho <andre@icmc.usp.br>,
+                       Rolf Backofen <backofen@informatik.uni-freiburg.de>
+
+    This file is part of CRISPRcasIdentifier.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os, json, pickle, hashlib
+import pandas as pd
+
+from functools import lru_cache
+
+STAMPS_DIR = '.stamps'
+
+class StageStamps:
+    # Results of the stages whose outputs are stored in a directory, each with the fingerprint of the inputs it was
+    # computed from (in a hidden subdirectory), so that a stage of a new run is skipped when its inputs did not change.
+
+    def __init__(self, output_dir):
+        self.stamps_dir = os.path.join(output_dir, STAMPS_DIR)
+
+    def load(self, stage, fingerprint):
+        # result of stage if it was computed from inputs with this fingerprint, None otherwise
+        stamp_file = os.path.join(self.stamps_dir, stage + '.pkl')
+
+        if not os.path.exists(stamp_file):
+            return None
+
+        with open(stamp_file, 'rb') as f:
+            stamp_fingerprint, result = pickle.load(f)
+
+        return result if stamp_fingerprint == fingerprint else None
+
+    def save(self, stage, fingerprint, result):
+        if not os.path.exists(self.stamps_dir):
+            os.makedirs(self.stamps_dir, exist_ok=True)
+
+        stamp_file = os.path.join(self.stamps_dir, stage + '.pkl')
+
+        with open(stamp_file + '.tmp', 'wb') as f:
+            pickle.dump((fingerprint, result), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.replace(stamp_file + '.tmp', stamp_file)
+
+def fingerprint(*inputs):
+    # inputs must be JSON serialisable (e.g. digests of files and option values)
+    return hashlib.md5(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+def file_digest(path):
+    stat = os.stat(path)
+    return cached_file_digest(os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+
+@lru_cache(maxsize=1024)
+def cached_file_digest(path, size, mtime_ns):
+    # the content of each file version is only read once per run
+    md5 = hashlib.md5()
+
+    with open(path, 'rb') as f:
+        for block in iter(lambda : f.read(1 << 20), b''):
+            md5.update(block)
+
+    return md5.hexdigest()
+
+def frame_digest(df):
+    md5 = hashlib.md5(json.dumps([str(c) for c in df.columns]).encode())
+    md5.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    return md5.hexdigest()
@@ -0,0 +1,86 @@
+"""
+    CRISPRcasIdentifier
+    Copyright (C) 2020 Victor Alexandre Padilha <victorpadilha@usp.br>,
+                       Omer Salem Alkhnbashi <alkhanbo@informatik.uni-freiburg.de>,
+                       Shiraz Ali Shah <shiraz.shah@dbac.dk>,
+                       André Carlos Ponce de Leon Ferreira de Carvalho <andre@icmc.usp.br>,
+                       Rolf Backofen <backofen@informatik.uni-freiburg.de>
+
+    This file is part of CRISPRcasIdentifier.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import os, sys, glob
+import joblib
+import numpy as np
+import pytest
+
+from sklearn.tree import DecisionTreeRegressor, DecisionTreeClassifier
+from sklearn.ensemble import ExtraTreesRegressor, ExtraTreesClassifier
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import CRISPRcasIdentifier as cci
+from flat_trees import flatten_model, save_flat_model, load_flat_model
+
+# the classifiers and the regressors of the first features of every HMM set, if trained_models.tar.gz was extracted
+SHIPPED_MODELS = sorted(glob.glob(os.path.join(cci.MODELS_DIR, '*_DecisionTreeClassifier.joblib')) + glob.glob(os.path.join(cci.MODELS_DIR, '*_ExtraTreesClassifier.joblib')) +
+                        glob.glob(os.path.join(cci.MODELS_DIR, '*_DecisionTreeRegressor_cas1.joblib')) + glob.glob(os.path.join(cci.MODELS_DIR, '*_ExtraTreesRegressor_cas1.joblib')))
+
+def cassette_vectors(model, n_samples=500, seed=0):
+    # scaled bitscores of a few proteins per cassette, and rows set to the thresholds of the model, where a
+    # comparison in another precision than sklearn's would go to the other child
+    rng = np.random.RandomState(seed)
+    n_features = model.n_features_in_
+    X = rng.rand(n_samples, n_features) * (rng.rand(n_samples, n_features) < 0.2)
+    trees = [model] if hasattr(model, 'tree_') else list(np.ravel(model.estimators_))
+    thresholds = np.concatenate([tree.tree_.threshold[tree.tree_.feature >= 0] for tree in trees])
+    features = np.concatenate([tree.tree_.feature[tree.tree_.feature >= 0] for tree in trees])
+    picked = rng.choice(len(thresholds), min(n_samples, len(thresholds)), replace=False)
+    X[np.arange(len(picked)), features[picked]] = thresholds[picked]
+    return X
+
+def assert_same_predictions(model, flat_model, X):
+    np.testing.assert_array_equal(flat_model.predict(X), model.predict(X))
+
+    if hasattr(model, 'predict_proba'):
+        np.testing.assert_array_equal(flat_model.predict_proba(X), model.predict_proba(X))
+
+def fitted_model(estimator):
+    rng = np.random.RandomState(0)
+    X = rng.rand(300, 8) * (rng.rand(300, 8) < 0.5)
+
+    if hasattr(estimator, 'predict_proba'):
+        return estimator.fit(X, np.array(['I-A', 'I-B', 'II-A', 'V-A'])[(X[:, :3].sum(axis=1) * 4).astype(int) % 4])
+
+    return estimator.fit(X[:, 1:], X[:, 0])
+
+@pytest.mark.parametrize('estimator', [DecisionTreeClassifier(random_state=0), ExtraTreesClassifier(n_estimators=20, random_state=0),
+                                       DecisionTreeRegressor(random_state=0), ExtraTreesRegressor(n_estimators=20, random_state=0)], ids=lambda e : type(e).__name__)
+def test_fitted_model(estimator, tmp_path):
+    model = fitted_model(estimator)
+    X = cassette_vectors(model)
+    assert_same_predictions(model, flatten_model(model), X)
+
+    # and from the memory-mapped copy
+    save_flat_model(flatten_model(model), str(tmp_path / 'model'))
+    assert_same_predictions(model, load_flat_model(str(tmp_path / 'model')), X)
+
+@pytest.mark.skipif(not SHIPPED_MODELS, reason='trained_models.tar.gz not extracted')
+@pytest.mark.parametrize('model_file', SHIPPED_MODELS, ids=os.path.basename)
+def test_shipped_model(model_file):
+    model = joblib.load(model_file)
+    assert_same_predictions(model, flatten_model(model), cassette_vectors(model))
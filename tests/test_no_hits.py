@@ -0,0 +1,88 @@
+"""
+    CRISPRcasIdentifier
+    Copyright (C) 2020 Victor Alexandre Padilha <victorpadilha@usp.br>,
+                       Omer Salem Alkhnbashi <alkhanbo@informatik.uni-freiburg.de>,
+                       Shiraz Ali Shah <shiraz.shah@dbac.dk>,
+                       André Carlos Ponce de Leon Ferreira de Carvalho <andre@icmc.usp.br>,
+                       Rolf Backofen <backofen@informatik.uni-freiburg.de>
+
+    This file is part of CRISPRcasIdentifier.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os, sys
+import joblib
+import numpy as np
+import pandas as pd
+import pytest
+
+from argparse import Namespace
+from sklearn.preprocessing import MaxAbsScaler, LabelEncoder
+from sklearn.tree import DecisionTreeRegressor, DecisionTreeClassifier
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import CRISPRcasIdentifier as cci
+from model_registry import ModelRegistry
+from prediction_memo import predict_unique
+
+HMM = 'HMM2019'
+FEATURES = np.array(['cas1', 'cas2', 'cas3'])
+
+@pytest.fixture
+def registry(tmp_path):
+    # small models with the names and the layout of the trained_models folder
+    rng = np.random.RandomState(0)
+    X = rng.rand(40, len(FEATURES)) * 100
+    y = np.array(['I-A', 'II-A'])[rng.randint(0, 2, 40)]
+    scaler = MaxAbsScaler().fit(X)
+    X = scaler.transform(X)
+    encoder = LabelEncoder().fit(y)
+
+    joblib.dump(FEATURES, str(tmp_path / (HMM + '_features.joblib')))
+    joblib.dump(scaler, str(tmp_path / (HMM + '_scaler.joblib')))
+    joblib.dump(encoder, str(tmp_path / (HMM + '_encoder.joblib')))
+    joblib.dump(DecisionTreeClassifier(random_state=0).fit(X, encoder.transform(y)), str(tmp_path / (HMM + '_DecisionTreeClassifier.joblib')))
+
+    for j, feature in enumerate(FEATURES):
+        regressor = DecisionTreeRegressor(random_state=0).fit(np.delete(X, j, axis=1), X[:, j])
+        joblib.dump(regressor, str(tmp_path / '{}_DecisionTreeRegressor_{}.joblib'.format(HMM, feature)))
+
+    return ModelRegistry(str(tmp_path))
+
+def no_hits(fasta_file, args, protein_df, hmmsearch_output_dir, hit_cache=None):
+    # what parse_hmmsearch_hits gives for hmmsearch outputs without any hit
+    return {hmm : pd.DataFrame({'protein' : [], 'annotation' : [], 'bitscore' : np.array([], dtype=float)}) for hmm in args.hmm_sets}
+
+def server_args(**options):
+    args = Namespace(sequence_type='protein', sequence_completeness='complete', run_mode='combined', regressors=['CART'], classifiers=['CART'], hmm_sets=[HMM],
+                     probability=False, threads=None, incremental=False, two_stage_search=False, cassette_arrays=None, hmm_database=False, hmm_shards=1,
+                     hmmsearch_raw_output='files')
+    vars(args).update(options)
+    return args
+
+def test_predict_unique_without_rows():
+    def predict(X):
+        raise AssertionError('models must not be called without rows')
+
+    assert predict_unique(predict, np.empty((0, len(FEATURES)))).shape == (0,)
+
+@pytest.mark.parametrize('run_mode', ['classification', 'regression', 'combined'])
+@pytest.mark.parametrize('probability', [False, True])
+def test_payload_without_hits(registry, monkeypatch, run_mode, probability):
+    # a protein fasta file without any hit makes a single cassette of unknown proteins, which nothing is predicted for
+    monkeypatch.setattr(cci, 'search_hmm_sets', no_hits)
+    payload = {'fasta' : '>p1 protein 1\nMKVLAAGIVGL\n>p2 protein 2\nMSTNPKPQRKT\n', 'run_mode' : run_mode, 'probability' : probability}
+    assert cci.predict_payload(payload, server_args(), registry) == []
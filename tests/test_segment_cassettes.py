@@ -0,0 +1,124 @@
+"""
+    CRISPRcasIdentifier
+    Copyright (C) 2020 Victor Alexandre Padilha <victorpadilha@usp.br>,
+                       Omer Salem Alkhnbashi <alkhanbo@informatik.uni-freiburg.de>,
+                       Shiraz Ali Shah <shiraz.shah@dbac.dk>,
+                       André Carlos Ponce de Leon Ferreira de Carvalho <andre@icmc.usp.br>,
+                       Rolf Backofen <backofen@informatik.uni-freiburg.de>
+
+    This file is part of CRISPRcasIdentifier.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import os, sys
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import CRISPRcasIdentifier as cci
+from cas import CORE
+
+ANNOTATIONS = ['unknown'] * 6 + ['cas1', 'cas2', 'cas4', 'cas6', 'cas3', 'cas9', 'cas7', 'csn2']
+
+def reference_cassettes(protein_df, max_gap=cci.MAX_GAP, min_proteins=2, max_nt_diff=500):
+    # the row by row loop build_cassettes used before segment_cassettes, run on each contig, where the end of the
+    # contig also closes the cassette being built
+    cassettes = []
+
+    def close(contig_df, indices_cassette):
+        for idx2filter in list(reversed(indices_cassette)):
+            if contig_df.at[idx2filter, 'annotation'] == 'unknown':
+                indices_cassette.pop()
+            else:
+                break
+
+        protein_df_cassette = contig_df.loc[indices_cassette]
+        unique_cassette_proteins = set(protein_df_cassette[protein_df_cassette['annotation'] != 'unknown']['annotation'])
+
+        if len(unique_cassette_proteins) > 1 and len(unique_cassette_proteins.intersection(CORE)) >= 1:
+            cassettes.append(indices_cassette)
+
+    runs = (protein_df['contig'] != protein_df['contig'].shift()).cumsum()
+
+    for _, contig_df in protein_df.groupby(runs, sort=False):
+        indices_cassette = []
+        gap = 0
+        cas_count = 0
+
+        for i, (idx, row) in enumerate(contig_df.iterrows()):
+            nt_diff = row['start'] - contig_df.iloc[i - 1]['end'] if i > 0 else 0
+
+            if ((row['annotation'] != 'unknown' and len(indices_cassette) == 0) or \
+                (row['annotation'] != 'unknown' and nt_diff <= max_nt_diff)) and \
+                gap <= max_gap:
+                indices_cassette.append(idx)
+                gap = 0
+                cas_count += 1
+
+            elif i > 0 and len(indices_cassette) > 0 and row['annotation'] == 'unknown' and nt_diff <= max_nt_diff and gap < max_gap:
+                indices_cassette.append(idx)
+                gap += 1
+
+            else:
+                if len(indices_cassette) > 0 and cas_count >= min_proteins:
+                    close(contig_df, indices_cassette)
+
+                gap = 0
+                cas_count = 0
+                indices_cassette = []
+
+        if len(indices_cassette) > 0 and cas_count >= min_proteins:
+            close(contig_df, indices_cassette)
+
+    return [idx for c in cassettes for idx in c], [i + 1 for i, c in enumerate(cassettes) for _ in c]
+
+def random_proteins(seed, n_contigs=4, n_proteins=400):
+    # contigs of proteins with gaps around max_nt_diff; a contig name may come back after another one
+    rng = np.random.RandomState(seed)
+    contigs = rng.choice(['ctg{}'.format(i) for i in range(n_contigs)], n_proteins // 20)
+    contigs = np.repeat(contigs, rng.multinomial(n_proteins - len(contigs), np.ones(len(contigs)) / len(contigs)) + 1)
+    starts = np.cumsum(rng.randint(300, 1500, len(contigs)))
+    ends = starts + rng.randint(200, 800, len(contigs))
+    return pd.DataFrame({'contig' : contigs, 'start' : starts, 'end' : ends, 'annotation' : rng.choice(ANNOTATIONS, len(contigs)),
+                         'bitscore' : rng.rand(len(contigs)) * 100}, index=['p{}'.format(i) for i in range(len(contigs))])
+
+@pytest.mark.parametrize('seed', range(20))
+def test_same_cassettes_as_row_loop(seed):
+    protein_df = random_proteins(seed)
+    cassette_df = cci.build_cassettes({'H' : protein_df}, 'dna')['H']
+    proteins, cassette_ids = reference_cassettes(protein_df)
+
+    assert len(proteins) > 0
+    assert cassette_df.index.tolist() == proteins
+    assert cassette_df['cassette_id'].tolist() == cassette_ids
+
+@pytest.mark.parametrize('max_gap', [0, 1, 3])
+def test_same_cassettes_as_row_loop_max_gap(max_gap):
+    protein_df = random_proteins(max_gap)
+    cassette_df = cci.build_cassettes({'H' : protein_df}, 'dna', max_gap=max_gap)['H']
+    assert (cassette_df.index.tolist(), cassette_df['cassette_id'].tolist()) == reference_cassettes(protein_df, max_gap=max_gap)
+
+def test_same_cassettes_in_worker_processes(monkeypatch):
+    protein_df = random_proteins(0)
+    serial_df = cci.build_cassettes({'H' : protein_df}, 'dna')['H']
+    monkeypatch.setattr(cci, 'PARALLEL_SEGMENT_PROTEINS', 1)
+    pd.testing.assert_frame_equal(cci.build_cassettes({'H' : protein_df}, 'dna', n_jobs=2)['H'], serial_df)
+
+def test_empty_table():
+    protein_df = random_proteins(0).iloc[:0]
+    assert cci.build_cassettes({'H' : protein_df}, 'dna')['H'].shape[0] == 0
@@ -0,0 +1,123 @@
+"""
+    CRISPRcasIdentifier
+    Copyright (C) 2020 Victor Alexandre Padilha <victorpadilha@usp.br>,
+                       Omer Salem Alkhnbashi <alkhanbo@informatik.uni-freiburg.de>,
+                       Shiraz Ali Shah <shiraz.shah@dbac.dk>,
+                       André Carlos Ponce de Leon Ferreira de Carvalho <andre@icmc.usp.br>,
+                       Rolf Backofen <backofen@informatik.uni-freiburg.de>
+
+    This file is part of CRISPRcasIdentifier.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+
+import os, sys
+import numpy as np
+import pandas as pd
+import pytest
+
+from argparse import Namespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import CRISPRcasIdentifier as cci
+from fasta import fasta_index
+
+HMM = 'HMMT'
+PROFILES = ['cas1_0000.hmm', 'cas2_0001.hmm', 'cas4_0002.hmm', 'cas6_0003.hmm', 'csa1_0004.hmm', 'cas3_0005.hmm', 'cas9_0006.hmm', 'cas7_0007.hmm', 'csn2_0008.hmm']
+
+def write_genome(path, seed, n_contigs=3, n_proteins=150):
+    # prodigal-style protein fasta file, and the bitscores of the profiles hitting each protein
+    rng = np.random.RandomState(seed)
+    scores = {}
+
+    with open(path, 'w') as f:
+        for contig in range(n_contigs):
+            end = 0
+
+            for gene in range(1, n_proteins // n_contigs + 1):
+                start = end + rng.randint(50, 700)
+                end = start + rng.randint(200, 900)
+                header = '>ctg{}_{} # {} # {} # 1 # ID={}_{};partial=00'.format(contig, gene, start, end, contig + 1, gene)
+                f.write(header + '\nMSTNPKPQRKT\n')
+
+                for profile in rng.choice(PROFILES, rng.binomial(2, 0.15), replace=False):
+                    scores.setdefault(header, []).append((profile, rng.rand() * 200 - 10))
+
+    return scores
+
+def fake_hmmsearch(scores):
+    # the tblout lines of the given profiles for the proteins of fasta_file; the bitscore of a hit does not depend on
+    # the other proteins searched, as with the E-values of the whole file (see two_stage_search)
+    searches = []
+
+    def hmmsearch(hmmsearch_cmd, fasta_file, hmm_dir, hmm_sets, hmmsearch_output_dir, profiles=None, **options):
+        headers = fasta_index(fasta_file).headers
+        searches.append((len(headers), profiles))
+        tab_files = {}
+
+        for hmm in hmm_sets:
+            tab_files[hmm] = {}
+
+            for profile in (profiles[hmm] if profiles is not None else os.listdir(os.path.join(hmm_dir, hmm))):
+                lines = ['# tblout of {}\n'.format(profile)]
+
+                for header in headers:
+                    for hit_profile, bitscore in scores.get(header, []):
+                        if hit_profile == profile:
+                            target, description = header[1:].split(' ', 1)
+                            lines.append('{} - {} - 1e-10 {:.1f} 0.0 1e-10 {:.1f} 0.0 1 1 0 0 1 1 1 1 {}\n'.format(target, profile[:-4], bitscore, bitscore, description))
+
+                tab_files[hmm][profile.replace('.hmm', '.tab')] = lines
+
+        return tab_files
+
+    return hmmsearch, searches
+
+def search_args(two_stage_search):
+    return Namespace(sequence_type='dna', hmm_sets=[HMM], two_stage_search=two_stage_search, hmm_database=False, hmm_shards=1, threads=None,
+                     hmmsearch_raw_output='none', incremental=False)
+
+@pytest.fixture
+def hmm_dir(tmp_path, monkeypatch):
+    os.mkdir(str(tmp_path / 'HMM_sets'))
+    os.mkdir(str(tmp_path / 'HMM_sets' / HMM))
+
+    for profile in PROFILES:
+        open(str(tmp_path / 'HMM_sets' / HMM / profile), 'w').close()
+
+    monkeypatch.setattr(cci, 'HMM_DIR', str(tmp_path / 'HMM_sets'))
+    return tmp_path
+
+@pytest.mark.parametrize('seed', range(15))
+def test_same_cassettes_as_full_search(hmm_dir, monkeypatch, seed):
+    fasta_file = str(hmm_dir / 'proteins.fa')
+    hmmsearch, searches = fake_hmmsearch(write_genome(fasta_file, seed))
+    monkeypatch.setattr(cci, 'hmmsearch', hmmsearch)
+    protein_df = cci.build_initial_dataframe(fasta_file, 'dna')
+    cassettes = {}
+
+    for two_stage_search in (False, True):
+        output_dir = str(hmm_dir / 'two_stage_{}'.format(two_stage_search))
+        os.mkdir(output_dir)
+        hmm_hits = cci.search_hmm_sets(fasta_file, search_args(two_stage_search), protein_df, output_dir)
+        annotated = cci.annotate_proteins(protein_df, output_dir, [HMM], 'dna', hmm_hits=hmm_hits)
+        cassettes[two_stage_search] = cci.build_cassettes(annotated, 'dna')[HMM]
+
+    assert cassettes[False].shape[0] > 0
+    pd.testing.assert_frame_equal(cassettes[True], cassettes[False])
+
+    # the other profiles were only searched on the proteins near hits
+    assert len(searches) > 2 and sum(n_proteins for n_proteins, _ in searches[2:]) < protein_df.shape[0]